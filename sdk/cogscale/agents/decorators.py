@@ -18,14 +18,17 @@ from functools import wraps
 
 def generate_named_decorator():
     lookup = dict()
+    options = dict()
     def base_decorator(portableName=None, **kwargs):
         def decorator(f):
             name = portableName if portableName is not None else "__DEFAULT__"
             lookup[name] = f
+            options[name] = kwargs
             wraps(f)
             return f
         return decorator
     base_decorator.all = lookup
+    base_decorator.options = options
     return base_decorator
 
 insight = generate_named_decorator()
@@ -15,8 +15,10 @@
 #
 
 from decorators import setup, teardown
-from cogscale.exceptions.config_exception import InvalidAgentException
+from cogscale.exceptions.config_exception import ConfigurationException, InvalidAgentException
+from cogscale.util import tracing
 import logging
+from threading import Lock
 
 log = logging.getLogger()
 
@@ -28,20 +30,77 @@ class AgentEnvironment(object):
         self.agent_func = self._find_func(name, agent_type)
         if self.agent_func is None:
             raise InvalidAgentException("No function found decorated with %s named %s" % (agent_type.__name__, name))
+        self.agent_options = self._find_options(name, agent_type)
         self.teardown_func = self._find_func(name, teardown)
         self.context = initial_context
+        self.is_setup = False
+        # config the agent was last set up with and the number of jobs holding it set up, see acquire
+        self.setup_config = None
+        self.users = 0
+        self.setup_lock = Lock()
         log.debug("AgentEnvironment: setup[%s], run[%s], teardown[%s]" % (self.setup_func, self.agent_func, self.teardown_func))
 
     def _find_func(self, agent_name, func_type):
         return func_type.all.get(agent_name, func_type.all.get("__DEFAULT__"))
 
+    def _find_options(self, agent_name, func_type):
+        # keyword arguments given to the decorator, i.e. @predict("name", batch=True)
+        name = agent_name if agent_name in func_type.all else "__DEFAULT__"
+        return func_type.options.get(name, dict())
+
     def setup(self):
         if self.setup_func is not None:
-            self.setup_func(self.context)
+            with tracing.span("setup", "agent", {"agent": self.name}):
+                self.setup_func(self.context)
+
+    def setup_once(self, config=None):
+        """
+        Run setup unless it already ran, so concurrent jobs of one agent share a single set up context
+        :param config: config the context holds, a later acquire with the same config skips setup
+        :return: True if setup ran on this call
+        """
+        with self.setup_lock:
+            if self.is_setup:
+                return False
+            self.setup()
+            self.is_setup = True
+            self.setup_config = config
+            return True
+
+    def acquire(self, config):
+        """
+        Put config in the context and set the agent up for a job that tears it down with release.  Concurrent jobs
+        share the set up agent, so a job is rejected while jobs with another config hold it.  The agent is set up
+        again unless it already is with the same config, i.e. by a warmup.
+        :return: True if setup ran on this call
+        """
+        with self.setup_lock:
+            if self.users and config != self.setup_config:
+                raise ConfigurationException("Agent %s is running with another config" % self.name)
+            ran = not self.is_setup or config != self.setup_config
+            if ran:
+                self.context.update(config)
+                self.setup()
+                self.is_setup = True
+                self.setup_config = config
+            self.users += 1
+            return ran
+
+    def release(self):
+        """
+        Tear the agent down once the last job that acquired it releases it
+        """
+        with self.setup_lock:
+            self.users -= 1
+            if self.users:
+                return
+            self.is_setup = False
+            self.teardown()
 
     def teardown(self):
         if self.teardown_func is not None:
-            self.teardown_func(self.context)
+            with tracing.span("teardown", "agent", {"agent": self.name}):
+                self.teardown_func(self.context)
 
     def run(self, *args, **kwargs):
         # filter passed arguments down to only those the agent supports
@@ -49,5 +108,8 @@ class AgentEnvironment(object):
         agent_sig = inspect.getargspec(self.agent_func)
         agent_args = {key: kwargs[key] for key in kwargs if key in agent_sig[0]}
 
-        return self.agent_func(self.context, *args, **agent_args)
+        with tracing.span("run", "agent", {"agent": self.name}):
+            result = self.agent_func(self.context, *args, **agent_args)
+        # generator agents do their work as they are iterated
+        return tracing.trace_iter(result, "next")
 
@@ -0,0 +1,98 @@
+#
+# Copyright 2016 CognitiveScale, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Compares jsonpickle's encode(obj, unpicklable=False) with RecordEncoder on synthetic ARD records.
+
+    python -m cogscale.benchmarks.encoding --records 20000
+"""
+
+import timeit
+from datetime import datetime
+
+import click
+from jsonpickle import encode, handlers as json_handlers
+
+from cogscale.types.fields import StringField, IndexKeyField, IntegerField, EdgeField
+from cogscale.types.nodes import Node
+from cogscale.types.records import Record, BrandInfo, SecurityInfo
+from cogscale.util.encoder import Iso8601Handler, RecordEncoder
+
+
+class BenchAirport(Node):
+    code = IndexKeyField()
+    name = StringField()
+
+
+class BenchBooking(Node):
+    reference = IndexKeyField()
+    fare = IntegerField()
+    airports = EdgeField("DEPARTS_FROM", "HAS_DEPARTURE")
+
+
+def synthetic_records(count):
+    security = SecurityInfo("public")
+    brand = BrandInfo("bench", "encoding", {"region": "us", "retries": 3})
+    airports = [BenchAirport(code="A%02d" % i, name=u"Airport %d" % i) for i in range(10)]
+    records = []
+    for i in range(count):
+        if i % 2:
+            data = {"id": i, "name": u"traveller %d" % i, "tags": ["a", "b", "c"],
+                    "itinerary": {"legs": [{"from": "AUS", "to": "SFO", "seq": leg} for leg in range(3)],
+                                  "booked": datetime(2016, 7, 1, 12, i % 60)}}
+        else:
+            data = BenchBooking(reference="R%d" % i, fare=i, airports=[airports[i % 10]])
+        records.append(Record(data, "bench", security, brand).to_ardrecord())
+    return records
+
+
+def run(count, repeat):
+    json_handlers.register(datetime, Iso8601Handler)
+    records = synthetic_records(count)
+    encoder = RecordEncoder()
+    for record in records:
+        if encoder.encode(record) != encode(record, unpicklable=False):
+            raise AssertionError("RecordEncoder output differs from jsonpickle for %r" % record)
+
+    def jsonpickle_path():
+        for record in records:
+            encode(record, unpicklable=False)
+
+    def compiled_path():
+        for record in records:
+            encoder.encode(record)
+
+    results = {}
+    for (name, func) in [("jsonpickle", jsonpickle_path), ("compiled", compiled_path)]:
+        elapsed = min(timeit.repeat(func, number=1, repeat=repeat))
+        results[name] = {"seconds": elapsed, "recordsPerSecond": count / elapsed}
+    results["speedup"] = results["jsonpickle"]["seconds"] / results["compiled"]["seconds"]
+    return results
+
+
+@click.command()
+@click.option("--records", default=10000, help="Number of synthetic records to encode per pass.")
+@click.option("--repeat", default=5, help="Passes per encoder, the fastest pass is reported.")
+def main(records, repeat):
+    """Check RecordEncoder produces the same bytes as jsonpickle and compare their throughput"""
+    results = run(records, repeat)
+    for name in ["jsonpickle", "compiled"]:
+        click.echo("%-10s %8.3fs %10.0f records/s" % (name, results[name]["seconds"], results[name]["recordsPerSecond"]))
+    click.echo("speedup    %8.2fx" % results["speedup"])
+
+
+if __name__ == "__main__":
+    main()
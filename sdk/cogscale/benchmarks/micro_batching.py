@@ -0,0 +1,114 @@
+#
+# Copyright 2016 CognitiveScale, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Compares predict_single calls made from many threads on a model directly and through a MicroBatcher, for 1-D and
+single row 2-D samples.  Exits non-zero when a batched prediction differs from the unbatched one.
+
+    python -m cogscale.benchmarks.micro_batching --threads 16 --predictions 2000
+"""
+
+import sys
+import time
+from Queue import Queue, Empty
+from threading import Thread
+
+import click
+import numpy
+
+from cogscale.types.models import Model
+from cogscale.util.batching import MicroBatcher
+
+SHAPES = ["1d", "2d"]
+
+
+class BenchModel(object):
+    """
+    Stand in for a fitted linear estimator, predict takes a 2-D array like scikit-learn
+    """
+
+    def __init__(self, features, outputs):
+        self.coefficients = numpy.random.random_sample((features, outputs))
+
+    def predict(self, x):
+        return numpy.dot(numpy.atleast_2d(x), self.coefficients)
+
+
+def samples(shape, features, count):
+    rows = numpy.random.random_sample((count, features))
+    return [row if shape == "1d" else row.reshape(1, features) for row in rows]
+
+
+def predict_threaded(model, xs, threads):
+    """
+    :return: (seconds, predictions in the order of xs)
+    """
+    predictions = [None] * len(xs)
+    indexes = Queue()
+    for index in xrange(len(xs)):
+        indexes.put(index)
+
+    def work():
+        while True:
+            try:
+                index = indexes.get_nowait()
+            except Empty:
+                return
+            predictions[index] = model.predict_single(xs[index])
+
+    workers = [Thread(target=work, name="bench_predict") for _ in range(threads)]
+    started = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return time.time() - started, predictions
+
+
+def mismatches(expected, actual):
+    return sum(1 for (e, a) in zip(expected, actual)
+               if numpy.shape(e) != numpy.shape(a) or not numpy.allclose(e, a))
+
+
+@click.command()
+@click.option("--threads", default=16, help="Threads calling predict_single at once.")
+@click.option("--predictions", default=2000, help="Predictions per shape.")
+@click.option("--features", default=100, help="Features per sample.")
+@click.option("--outputs", default=10, help="Outputs per prediction.")
+def main(threads, predictions, features, outputs):
+    """Benchmark micro-batched predictions and check they match unbatched ones"""
+    model = Model("bench", BenchModel(features, outputs), accessor_func=lambda m: m.predict)
+    failed = False
+    click.echo("%-6s %12s %12s %12s %10s" % ("shape", "direct/s", "batched/s", "mean batch", "mismatches"))
+    for shape in SHAPES:
+        xs = samples(shape, features, predictions)
+        (direct_seconds, expected) = predict_threaded(model, xs, threads)
+        batcher = MicroBatcher(model)
+        try:
+            (batched_seconds, actual) = predict_threaded(batcher, xs, threads)
+        finally:
+            batcher.close()
+        count = mismatches(expected, actual)
+        failed = failed or count > 0
+        click.echo("%-6s %12.0f %12.0f %12.1f %10d" % (shape, predictions / direct_seconds,
+                                                       predictions / batched_seconds,
+                                                       batcher.stats()["meanBatchSize"], count))
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
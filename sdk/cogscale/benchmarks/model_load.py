@@ -0,0 +1,141 @@
+#
+# Copyright 2016 CognitiveScale, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Compares loading a model.bin written as a plain pickle through the old text mode readlines() loader with loading
+the container written by Model.dump, uncompressed and with every installed codec.  Each load runs in a forked child
+and reports load time and how much the peak RSS grew.
+
+    python -m cogscale.benchmarks.model_load --megabytes 500
+"""
+
+import json
+import os
+import resource
+import shutil
+import tempfile
+import time
+import traceback
+
+import click
+import numpy
+
+from cogscale.types.models import Model
+from cogscale.util import compression
+
+LOADERS = ["readlines", compression.NONE] + [codec for codec in compression.available_codecs()
+                                             if codec != compression.NONE]
+
+
+class BenchModel(object):
+    """
+    Stand in for a fitted estimator: a few large coefficient arrays and some small parameters
+    """
+
+    def __init__(self, megabytes, arrays=4, random=True):
+        rows = megabytes * 1024 * 1024 / 8 / arrays / 100
+        if random:
+            self.coefficients = [numpy.random.random_sample((rows, 100)) for _ in range(arrays)]
+        else:
+            self.coefficients = [numpy.tile(numpy.random.random_sample(100), (rows, 1)) for _ in range(arrays)]
+        self.intercept = numpy.zeros(100)
+        self.params = {"alpha": 0.1, "classes": range(10)}
+
+    def predict(self, x):
+        return sum(numpy.dot(coefficients[:1], x) for coefficients in self.coefficients)
+
+
+def model_name(loader):
+    return "model.pickle" if loader == "readlines" else "model-%s.bin" % loader
+
+
+def readlines_load(workspace_path, model_name="model.bin"):
+    # Model.load before the container format
+    with open(os.path.join(workspace_path, model_name), "r") as model_file:
+        model_str = model_file.readlines()
+        return Model.loads("".join(model_str))
+
+
+def measure(loader, workspace_path):
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.time()
+    if loader == "readlines":
+        model = readlines_load(workspace_path, model_name(loader))
+    else:
+        model = Model.load(workspace_path, model_name(loader))
+    seconds = time.time() - started
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # a first prediction only faults in the pages it reads
+    started = time.time()
+    model.predict_single(numpy.ones(100))
+    return {"loader": loader,
+            "loadSeconds": seconds,
+            "firstPredictSeconds": time.time() - started,
+            "peakRssGrowthKb": peak_rss - start_rss}
+
+
+def measure_forked(loader, workspace_path):
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        code = 1
+        try:
+            with os.fdopen(write_fd, "w") as out:
+                json.dump(measure(loader, workspace_path), out)
+            code = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(code)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as result:
+        data = result.read()
+    (_, code) = os.waitpid(pid, 0)
+    if code != 0 or not data:
+        raise RuntimeError("%s load failed" % loader)
+    return json.loads(data)
+
+
+@click.command()
+@click.option("--megabytes", default=200, help="Size of the arrays in the synthetic model.")
+@click.option("--repeat", default=3, help="Loads per loader, the fastest is reported.")
+@click.option("--random/--repetitive", default=True,
+              help="Fill the arrays with random values (barely compressible) or repeated rows.")
+def main(megabytes, repeat, random):
+    """Benchmark model.bin load time and peak RSS"""
+    workspace_path = tempfile.mkdtemp()
+    try:
+        model = Model("bench", BenchModel(megabytes, random=random), accessor_func=lambda m: m.predict)
+        with open(os.path.join(workspace_path, model_name("readlines")), "wb") as model_file:
+            model_file.write(Model.dumps(model))
+        for codec in LOADERS[1:]:
+            Model.dump(model, workspace_path, model_name(codec), codec=codec)
+        del model
+        click.echo("%-10s %10s %12s %12s %18s" % ("loader", "file MB", "load s", "predict s", "peak RSS +KB"))
+        for loader in LOADERS:
+            size = os.path.getsize(os.path.join(workspace_path, model_name(loader))) / 1024.0 / 1024.0
+            result = min((measure_forked(loader, workspace_path) for _ in range(repeat)),
+                         key=lambda r: r["loadSeconds"])
+            click.echo("%-10s %10.1f %12.3f %12.3f %18d" % (loader, size, result["loadSeconds"],
+                                                           result["firstPredictSeconds"],
+                                                           result["peakRssGrowthKb"]))
+    finally:
+        shutil.rmtree(workspace_path)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,307 @@
+#
+# Copyright 2016 CognitiveScale, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Drives every pipe runner process with synthetic agents over an in-memory pipe and reports records/sec, per record
+latency and peak RSS for each payload size.  Each scenario runs in a forked child so peak RSS is its own.
+
+    python -m cogscale.benchmarks.processes --records 5000 --output results.json
+    python -m cogscale.benchmarks.processes --records 5000 --compare results.json
+"""
+
+import json
+import logging
+import os
+import platform
+import resource
+import sys
+import time
+import traceback
+from datetime import datetime
+from Queue import Queue
+from threading import Thread, Event
+
+import click
+
+from cogscale.agents.decorators import source, enrichment, predict, train, publish
+from cogscale.agents.environment import AgentEnvironment
+from cogscale.types.records import Record, BrandInfo, SecurityInfo, PublishStatus
+from cogscale.util.metrics import Histogram
+from cogscale.util.pipe_runner import PipeRunner, MessagePipe, SourcingProcess, EnrichmentProcess, \
+    PredictionProcess, LearningProcess, PublishProcess
+
+SCENARIOS = ["source", "enrich", "predict", "train", "publish"]
+# number of fields in a synthetic payload
+PAYLOAD_SIZES = {"small": 4, "medium": 40, "large": 400}
+DEFAULT_REGRESSION_THRESHOLD = 0.1
+
+_security = SecurityInfo("public")
+_brand = BrandInfo("bench", "processes", {"region": "us"})
+
+
+def synthetic_payload(size, index):
+    payload = {"id": index, "emitted": None}
+    for field in range(PAYLOAD_SIZES[size] - 2):
+        if field % 3 == 0:
+            payload["s%d" % field] = u"value %d of record %d" % (field, index)
+        elif field % 3 == 1:
+            payload["n%d" % field] = index * field
+        else:
+            payload["l%d" % field] = [index, field, "x"]
+    return payload
+
+
+def stamped(payload):
+    # the pipe measures latency from this stamp to the moment the record is written
+    payload = dict(payload)
+    payload["emitted"] = time.time()
+    return payload
+
+
+@source("bench_source")
+def bench_source(context):
+    payload = synthetic_payload(context["size"], 0)
+    for i in xrange(context["records"]):
+        yield Record(stamped(payload), "bench", _security, _brand)
+
+
+@enrichment("bench_enrich")
+def bench_enrich(context, data):
+    yield Record(stamped(data.value), "bench", _security, _brand)
+
+
+@predict("bench_predict")
+def bench_predict(context, value):
+    return stamped(value)
+
+
+@train("bench_train")
+def bench_train(context, data):
+    fields = 0
+    for value in data:
+        fields += len(value)
+    return {"records": len(data), "fields": fields}
+
+
+@publish("bench_publish")
+def bench_publish(context, data):
+    return [PublishStatus(data, success=True)]
+
+
+class NullOutput(object):
+    def __init__(self):
+        self.bytes = 0
+
+    def write(self, data):
+        self.bytes += len(data)
+
+    def flush(self):
+        pass
+
+
+class BenchPipe(MessagePipe):
+    """
+    In-memory pipe in the spirit of the harness pipe.  Messages are encoded with the default framing and
+    discarded, and the latency of every stamped record is recorded once it has been written.
+    """
+
+    def __init__(self):
+        super(BenchPipe, self).__init__(input=None, output=NullOutput())
+        self.commands = Queue()
+        self.latency = Histogram()
+        self.finished = Event()
+        self.finished_at = None
+        self.final_status = None
+
+    def send(self, obj):
+        super(BenchPipe, self).send(obj)
+        response = obj.get("response")
+        if response == "DATA":
+            payload = obj.get("payload")
+            # predictions send a list of values, the other processes an ARD record
+            values = payload.get("body") if "body" in payload else [payload.get("d")]
+            written = time.time()
+            for value in values:
+                if isinstance(value, dict) and value.get("emitted"):
+                    self.latency.record(written - value["emitted"])
+        elif response == "STATUS" and not self.finished.is_set():
+            # the agent thread sends a final STATUS once the run is over
+            self.finished_at = time.time()
+            self.final_status = obj.get("payload")
+            self.finished.set()
+
+    def receive(self):
+        return self.commands.get(block=True)
+
+
+def scenario_start(scenario, size, records):
+    """
+    :return: (process, START payload) for a scenario
+    """
+    query_config = {"data": {"type": "query"}}
+    values = [synthetic_payload(size, i) for i in xrange(records)]
+    if scenario == "source":
+        environment = AgentEnvironment("bench_source", source, initial_context=dict())
+        return SourcingProcess(environment), {"config": {"size": size, "records": records}}
+    if scenario == "enrich":
+        environment = AgentEnvironment("bench_enrich", enrichment, initial_context=dict())
+        uows = [{"key": i, "value": value} for (i, value) in enumerate(values)]
+        return EnrichmentProcess(environment), {"config": query_config, "data": uows}
+    if scenario == "predict":
+        environment = AgentEnvironment("bench_predict", predict, initial_context=dict())
+        # streamed so latency reflects each chunk rather than the whole command
+        return PredictionProcess(environment), {"config": {}, "stream": True, "command": {"body": values}}
+    if scenario == "train":
+        environment = AgentEnvironment("bench_train", train, initial_context=dict())
+        return LearningProcess(environment), {"config": {}, "data": values}
+    if scenario == "publish":
+        environment = AgentEnvironment("bench_publish", publish, initial_context=dict())
+        uows = [{"key": i, "value": value} for (i, value) in enumerate(values)]
+        return PublishProcess(environment), {"config": query_config, "data": uows}
+    raise ValueError("Unknown scenario %s, expected one of %s" % (scenario, SCENARIOS))
+
+
+def measure(scenario, size, records):
+    """
+    Run one scenario through PipeRunner in this process
+    :return: dict of results
+    """
+    start_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    (process, start) = scenario_start(scenario, size, records)
+    pipe = BenchPipe()
+    runner = PipeRunner(pipe=pipe, process=process)
+
+    def stop_when_finished():
+        pipe.finished.wait()
+        pipe.commands.put({"request": "STOP", "payload": {"timeout": 0.1}})
+
+    Thread(target=stop_when_finished, name="bench_stop").start()
+    started = time.time()
+    pipe.commands.put({"request": "START", "payload": start})
+    runner.start()
+    seconds = pipe.finished_at - started
+    status = pipe.final_status
+    latency = pipe.latency.snapshot()
+    if not latency["count"]:
+        # train and publish send no records, their agent timing is the closest per record figure
+        latency = status.metrics["timings"].get("agent", latency)
+    return {"scenario": scenario,
+            "size": size,
+            "records": records,
+            "seconds": seconds,
+            "recordsPerSecond": records / seconds if seconds else 0.0,
+            "bytesSent": pipe.output.bytes,
+            "latency": latency,
+            "completed": status.completed,
+            "startRssKb": start_rss,
+            "peakRssKb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}
+
+
+def measure_forked(scenario, size, records):
+    """
+    Run measure in a child process so peak RSS only covers one scenario
+    """
+    (read_fd, write_fd) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_fd)
+        code = 1
+        try:
+            with os.fdopen(write_fd, "w") as out:
+                json.dump(measure(scenario, size, records), out)
+            code = 0
+        except Exception:
+            traceback.print_exc()
+        finally:
+            os._exit(code)
+    os.close(write_fd)
+    with os.fdopen(read_fd) as result:
+        data = result.read()
+    (_, code) = os.waitpid(pid, 0)
+    if code != 0 or not data:
+        raise RuntimeError("%s scenario with %s payloads failed" % (scenario, size))
+    return json.loads(data)
+
+
+def run(records, scenarios=SCENARIOS, sizes=sorted(PAYLOAD_SIZES.keys()), label=None):
+    results = []
+    for scenario in scenarios:
+        for size in sizes:
+            results.append(measure_forked(scenario, size, records))
+    return {"label": label or platform.node(),
+            "timestamp": datetime.utcnow().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "records": records,
+            "results": results}
+
+
+def compare(baseline, current, threshold=DEFAULT_REGRESSION_THRESHOLD):
+    """
+    Match results by scenario and payload size
+    :return: list of (scenario, size, baseline records/sec, current records/sec, change, regressed)
+    """
+    previous = dict(((result["scenario"], result["size"]), result) for result in baseline["results"])
+    rows = []
+    for result in current["results"]:
+        before = previous.get((result["scenario"], result["size"]))
+        if before is None or not before["recordsPerSecond"]:
+            continue
+        change = result["recordsPerSecond"] / before["recordsPerSecond"] - 1
+        rows.append((result["scenario"], result["size"], before["recordsPerSecond"], result["recordsPerSecond"],
+                     change, change < -threshold))
+    return rows
+
+
+@click.command()
+@click.option("--records", default=2000, help="Records per scenario.")
+@click.option("--scenario", "scenarios", multiple=True, type=click.Choice(SCENARIOS),
+              help="Scenario to run, may be repeated.  Defaults to every scenario.")
+@click.option("--size", "sizes", multiple=True, type=click.Choice(sorted(PAYLOAD_SIZES.keys())),
+              help="Payload size to run, may be repeated.  Defaults to every size.")
+@click.option("--label", help="Name stored with the results, defaults to the host name.")
+@click.option("--output", type=click.Path(dir_okay=False, writable=True), help="Save the results as JSON.")
+@click.option("--compare", "baseline", type=click.File(), help="Results of an earlier run to compare against.")
+@click.option("--threshold", default=DEFAULT_REGRESSION_THRESHOLD,
+              help="Drop in records/sec counted as a regression when comparing.")
+def main(records, scenarios, sizes, label, output, baseline, threshold):
+    """Benchmark the pipe runner processes with synthetic agents"""
+    logging.basicConfig(level=logging.WARN)
+    results = run(records, list(scenarios) or SCENARIOS, list(sizes) or sorted(PAYLOAD_SIZES.keys()), label)
+    click.echo("%-8s %-7s %12s %10s %10s %10s %12s" % ("scenario", "size", "records/s", "p50 ms", "p95 ms",
+                                                       "p99 ms", "peak RSS KB"))
+    for result in results["results"]:
+        latency = result["latency"]
+        click.echo("%-8s %-7s %12.0f %10.3f %10.3f %10.3f %12d" % (result["scenario"], result["size"],
+                                                                   result["recordsPerSecond"], latency["p50Ms"],
+                                                                   latency["p95Ms"], latency["p99Ms"],
+                                                                   result["peakRssKb"]))
+    if output:
+        with open(output, "w") as out:
+            json.dump(results, out, indent=2, sort_keys=True)
+    if baseline:
+        rows = compare(json.load(baseline), results, threshold)
+        click.echo()
+        click.echo("%-8s %-7s %12s %12s %8s" % ("scenario", "size", "before", "after", "change"))
+        for (scenario, size, before, after, change, regressed) in rows:
+            click.echo("%-8s %-7s %12.0f %12.0f %+7.1f%%%s" % (scenario, size, before, after, change * 100,
+                                                               "  REGRESSION" if regressed else ""))
+        if any(row[5] for row in rows):
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
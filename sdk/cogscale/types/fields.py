@@ -16,6 +16,8 @@
 
 from cogscale.util.utils import is_sequence
 
+_LAYOUT_ATTRIBUTE = "_field_layout"
+
 
 class BaseField(object):
 
@@ -148,4 +150,62 @@ class EdgeField(BaseField):
         else:
             instance.__dict__[self.name].append(value)
 
-        # print self.name, instance.__dict__[self.name]
\ No newline at end of file
+        # print self.name, instance.__dict__[self.name]
+
+
+class FieldLayout(object):
+    """
+    The fields a class declares itself (inherited fields are not included), in the order of the class __dict__,
+    along with what graph building needs to know about them.  Computing it names each field after its attribute.
+    """
+
+    def __init__(self, cls):
+        self.fields = [(key, val) for (key, val) in cls.__dict__.iteritems() if isinstance(val, BaseField)]
+        for (key, field) in self.fields:
+            field.name = key
+        self.names = [key for (key, _) in self.fields]
+        self.edge_fields = [(key, field) for (key, field) in self.fields if isinstance(field, EdgeField)]
+        self.index_fields = [(key, field) for (key, field) in self.fields if isinstance(field, IndexKeyField)]
+        self.index_key = ":::".join(key for (key, _) in self.index_fields) or None
+        self.labels = self.labels_for(getattr(cls, "meta", dict()), cls)
+
+    @staticmethod
+    def labels_for(meta, cls):
+        labels = meta.get("labels")
+        if not is_sequence(labels) or len(labels) < 1:
+            return [cls.__name__]
+        return labels
+
+
+def field_layout(cls):
+    """
+    FieldLayout of cls, computed the first time it is needed and kept until an attribute of the class (or of one
+    of its bases) is set or deleted
+    """
+    layout = cls.__dict__.get(_LAYOUT_ATTRIBUTE)
+    if layout is None:
+        layout = FieldLayout(cls)
+        type.__setattr__(cls, _LAYOUT_ATTRIBUTE, layout)
+    return layout
+
+
+def invalidate_layout(cls):
+    if _LAYOUT_ATTRIBUTE in cls.__dict__:
+        type.__delattr__(cls, _LAYOUT_ATTRIBUTE)
+    for subclass in type.__subclasses__(cls):
+        invalidate_layout(subclass)
+
+
+class FieldLayoutMeta(type):
+    """
+    Metaclass dropping the cached FieldLayout of a class whenever one of its attributes changes, i.e. a field
+    added after the class was defined
+    """
+
+    def __setattr__(cls, name, value):
+        type.__setattr__(cls, name, value)
+        invalidate_layout(cls)
+
+    def __delattr__(cls, name):
+        type.__delattr__(cls, name)
+        invalidate_layout(cls)
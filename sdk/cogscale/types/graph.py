@@ -16,15 +16,17 @@
 
 import json
 import hashlib
+from collections import namedtuple
 from threading import Lock
 from uuid import uuid4
-from cogscale.types.fields import BaseField, IndexKeyField, EdgeField
+from cogscale.types.fields import EdgeField, FieldLayout, field_layout
 from cogscale.util.attribute_getter import AttributeGetter
-from cogscale.util.utils import is_sequence
 
 
 NODE_ID_PROPERTY = "correlationId"
 
+FieldValue = namedtuple("FieldValue", ["field", "value"])
+
 
 class Locator(AttributeGetter):
 
@@ -104,22 +106,47 @@ class FutureSubGraph(object):
     A collection of nodes and edges that are ready to be inserted or merged into a property graph.
     """
 
-    def __init__(self, correlation_id, space=None):
+    def __init__(self, correlation_id, space=None, merge=False):
+        """
+        :param merge: return the existing node for an upsert with the same locator (label, key, value) and the
+         existing edge for an identical edge instead of adding them again
+        """
         self.nodes = {}
         self.edges = {}
         self.space = space
         self.local_unique = 0
         self.local_unique_lock = Lock()
         self.correlation_id = correlation_id
+        self.merge = merge
+        self.merged_nodes = 0
+        self.merged_edges = 0
+        self._upserts = {}
+        self._established = {}
 
     def insert_node(self):
         return FutureNode(self, self.nodes, self._unique())
 
     def upsert_node(self, label, key, value):
-        return FutureNode(self, self.nodes, self._unique(), Locator(label=label, key=key, value=value))
+        if self.merge and value is not None:
+            node = self._upserts.get((label, key, value))
+            if node is not None:
+                self.merged_nodes += 1
+                return node
+        node = FutureNode(self, self.nodes, self._unique(), Locator(label=label, key=key, value=value))
+        if self.merge and value is not None:
+            self._upserts[(label, key, value)] = node
+        return node
 
     def establish_edge(self, from_node, to_node, rel_type):
-        return FutureEdge(self, self.edges, self._unique(), Locator(start=from_node.alias, end=to_node.alias, type=rel_type))
+        if self.merge:
+            edge = self._established.get((from_node.alias, to_node.alias, rel_type))
+            if edge is not None:
+                self.merged_edges += 1
+                return edge
+        edge = FutureEdge(self, self.edges, self._unique(), Locator(start=from_node.alias, end=to_node.alias, type=rel_type))
+        if self.merge:
+            self._established[(from_node.alias, to_node.alias, rel_type)] = edge
+        return edge
 
     def _unique(self):
         self.local_unique_lock.acquire()
@@ -155,41 +182,88 @@ class GraphBuilder(object):
 
         return g
 
+    def build_graph_batch(self, nodes, space=None, correlation_id=None):
+        """
+        One sub-graph for many nodes.  Nodes referenced from several of them (the same airport on many bookings)
+        are upserted once and identical edges established once, the sub-graph's merged_nodes and merged_edges count
+        how many were merged.  Properties of a merged node are updated in order, so the last value set wins as it
+        would when upserting the nodes one sub-graph at a time.  Nodes without index fields are inserted once per node
+        object.
+        """
+        if correlation_id is None:
+            correlation_id = str(uuid4())
+
+        g = FutureSubGraph(correlation_id, space, merge=True)
+        built = {}
+        for node in nodes:
+            self._create_node(g, node, correlation_id, built)
+
+        return g
+
     def _fields_for_node(self, node):
         fields = {}
-        for key, val in node.__class__.__dict__.iteritems():
-            if isinstance(val, BaseField):
-                value = None
-                if key in node.__dict__:
-                    value = node.__dict__[key]
-                if value is not None:
-                    fields[key] = AttributeGetter({'field': val, 'value': value})
+        values = node.__dict__
+        for key, field in field_layout(node.__class__).fields:
+            value = values.get(key)
+            if value is not None:
+                fields[key] = FieldValue(field, value)
         return fields
 
     def _index_for_node(self, node):
-        index_key = None
+        layout = field_layout(node.__class__)
         index_hash = None
-        for field_name, field in node.__class__.__dict__.iteritems():
-            if isinstance(field, IndexKeyField):
-                field_value = unicode(node.__dict__[field_name]).encode('utf-8')
-                if index_key is None:
-                    index_key = field_name
-                    if field_value:
-                        index_hash = hashlib.sha256()
-                        index_hash.update(field_value)
-                else:
-                    index_key += ":::" + field_name
-                    if field_value:
-                        if not index_hash:
-                            index_hash = hashlib.sha256()
-                        index_hash.update(field_value)
-        return index_key, index_hash.hexdigest() if index_hash else None
-
-    def _create_node(self, g, node, correlation_id):
-        labels = self._node_labels(node)
+        for field_name, field in layout.index_fields:
+            field_value = unicode(node.__dict__[field_name]).encode('utf-8')
+            if field_value:
+                if index_hash is None:
+                    index_hash = hashlib.sha256()
+                index_hash.update(field_value)
+        return layout.index_key, index_hash.hexdigest() if index_hash else None
+
+    def _create_node(self, g, node, correlation_id, built=None):
+        """
+        Builds the future nodes of node and every node reachable from it through edge fields, depth first with an
+        explicit stack so deep graphs do not hit the recursion limit.  A node object reached more than once, through
+        a cycle or two paths, becomes one future node with an edge for every path to it.  When g merges, reaching a
+        node object that an earlier call built counts as a merged node, once per call.
+        :param built: id of the node objects already built -> (node, future node)
+        :return: the future node of node, the one built earlier if node was already built
+        """
+        if built is None:
+            built = {}
+        known = built.get(id(node))
+        if known is not None:
+            if g.merge:
+                g.merged_nodes += 1
+            return known[1]
+        future_node = self._future_node(g, node, correlation_id, built)
+        reached = {id(node)}
+        # (future node, its remaining edge values, (parent future node, edge field) to link once it is hydrated)
+        stack = [(future_node, self._hydrate_node(future_node, self._fields_for_node(node)), None)]
+        while stack:
+            (parent, edge_values, link) = stack[-1]
+            for (field, edge_node) in edge_values:
+                known = built.get(id(edge_node))
+                if known is not None:
+                    if g.merge and id(edge_node) not in reached:
+                        g.merged_nodes += 1
+                    reached.add(id(edge_node))
+                    self._link_nodes(g, parent, known[1], field)
+                    continue
+                edge_future_node = self._future_node(g, edge_node, correlation_id, built)
+                reached.add(id(edge_node))
+                stack.append((edge_future_node, self._hydrate_node(edge_future_node, self._fields_for_node(edge_node)),
+                              (parent, field)))
+                break
+            else:
+                stack.pop()
+                if link is not None:
+                    self._link_nodes(g, link[0], parent, link[1])
+
+        return future_node
 
-        # Collect all node fields and index fields
-        fields = self._fields_for_node(node)
+    def _future_node(self, g, node, correlation_id, built):
+        labels = self._node_labels(node)
         index_key, index_value = self._index_for_node(node)
 
         if index_key is None:
@@ -199,28 +273,28 @@ class GraphBuilder(object):
 
         # Assign correlation ID for traceability
         future_node.add(NODE_ID_PROPERTY, correlation_id)
-
-        # Build out the sub-graph for this node
-        self._hydrate_node(g, future_node, fields, correlation_id)
+        built[id(node)] = (node, future_node)
 
         return future_node
 
-    def _hydrate_node(self, g, node, fields, correlation_id):
+    def _hydrate_node(self, node, fields):
+        """
+        Adds the property fields to node, yielding (edge field, node object) for the values of its edge fields
+        """
         for name, field_info in fields.iteritems():
             if isinstance(field_info.field, EdgeField):
                 for edge_node in field_info.value:
-                    edge_future_node = self._create_node(g, edge_node, correlation_id)
-                    g.establish_edge(node, edge_future_node, field_info.field.name)
-                    if field_info.field.inverse_name:
-                        g.establish_edge(edge_future_node, node, field_info.field.inverse_name)
+                    yield field_info.field, edge_node
             else:
                 node.add(name, field_info.value)
 
-    def _node_labels(self, node):
-        if 'labels' in node.meta:
-            labels = node.meta['labels']
-            if not is_sequence(labels) or len(labels) < 1:
-                return [node.__class__.__name__]
-            return labels
+    @staticmethod
+    def _link_nodes(g, node, edge_future_node, field):
+        g.establish_edge(node, edge_future_node, field.name)
+        if field.inverse_name:
+            g.establish_edge(edge_future_node, node, field.inverse_name)
 
-        return [node.__class__.__name__]
+    def _node_labels(self, node):
+        if 'meta' in node.__dict__:
+            return FieldLayout.labels_for(node.meta, node.__class__)
+        return field_layout(node.__class__).labels
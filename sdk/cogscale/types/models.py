@@ -16,12 +16,159 @@
 
 from pathlib import Path
 from cogscale.util.attribute_getter import AttributeGetter
+from cogscale.util import compression
 from cloud.serialization import cloudpickle
+from cStringIO import StringIO
 import base64
+import cPickle
+import logging
+import mmap
 import pickle
+import struct
 import tempfile
 from os import path
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+log = logging.getLogger()
+
+
+# model.bin container: header, the pickled model, then the raw data of its large arrays, both optionally
+# compressed.  Files without the magic are plain cloudpickle and still load.
+MODEL_MAGIC = "CSMD"
+MODEL_FORMAT_VERSION = 2
+# magic, version, codec, pickle length, stored pickle length, data length, stored data length
+_HEADER = struct.Struct("<4sHHQQQQ")
+# arrays smaller than this stay in the pickle
+OUT_OF_BAND_BYTES = 64 * 1024
+_ALIGNMENT = 64
+# tmpfs backed when available so shared models never hit the disk
+_SHARED_MEMORY_DIR = "/dev/shm" if path.isdir("/dev/shm") else None
+
+
+def _aligned(offset):
+    return (offset + _ALIGNMENT - 1) // _ALIGNMENT * _ALIGNMENT
+
+
+class _ModelPickler(cloudpickle.CloudPickler):
+    """
+    cloudpickle leaving large numpy arrays out of the pickle.  Each one is replaced by a reference to its offset in
+    the data section, which is laid out as the pickle is written.
+    """
+
+    def __init__(self, file, protocol=2):
+        cloudpickle.CloudPickler.__init__(self, file, protocol)
+        self.arrays = []
+        self.data_length = 0
+
+    def persistent_id(self, obj):
+        if numpy is None or type(obj) is not numpy.ndarray or obj.dtype.hasobject or obj.nbytes < OUT_OF_BAND_BYTES:
+            return None
+        if obj.flags.c_contiguous:
+            (order, data) = ("C", obj)
+        elif obj.flags.f_contiguous:
+            (order, data) = ("F", obj.T)
+        else:
+            (order, data) = ("C", numpy.ascontiguousarray(obj))
+        offset = _aligned(self.data_length)
+        self.arrays.append((offset, data))
+        self.data_length = offset + data.nbytes
+        return "ndarray", data.dtype.str, obj.shape, order, offset
+
+
+def _section(source, start, length):
+    """
+    read(n) over length bytes of a file (or mmap) starting at start
+    """
+    state = {"position": start}
+    end = start + length
+
+    def read(size):
+        position = state["position"]
+        source.seek(position)
+        data = source.read(min(size, end - position))
+        state["position"] = position + len(data)
+        return data
+
+    return read
+
+
+class _DecompressingReader(object):
+    """
+    File-like object for the unpickler over decompressed chunks, which are only decompressed as they are read
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffered = ""
+        self.position = 0
+
+    def _fill(self, size):
+        available = len(self.buffered) - self.position
+        if size is not None and available >= size:
+            return
+        # joined once, so a large read does not copy the buffer for every chunk
+        pending = [self.buffered[self.position:]]
+        while size is None or available < size:
+            chunk = next(self.chunks, None)
+            if chunk is None:
+                break
+            pending.append(chunk)
+            available += len(chunk)
+        self.buffered = "".join(pending)
+        self.position = 0
+
+    def read(self, size=-1):
+        self._fill(size if size >= 0 else None)
+        end = len(self.buffered) if size < 0 else self.position + size
+        data = self.buffered[self.position:end]
+        self.position += len(data)
+        return data
+
+    def readline(self):
+        while True:
+            end = self.buffered.find("\n", self.position)
+            if end >= 0:
+                return self.read(end + 1 - self.position)
+            available = len(self.buffered) - self.position
+            self._fill(available + 1)
+            if len(self.buffered) - self.position == available:
+                return self.read()
+
+
+def _decompress_data(chunks, data_length):
+    """
+    Decompress the data section straight into the buffer its arrays are views of
+    """
+    data = numpy.empty(data_length, dtype=numpy.uint8)
+    position = 0
+    for chunk in chunks:
+        data[position:position + len(chunk)] = numpy.frombuffer(chunk, dtype=numpy.uint8)
+        position += len(chunk)
+    # read only like the arrays of an uncompressed model
+    data.flags.writeable = False
+    return data
+
+
+def _array_loader(buf, data_offset):
+    def persistent_load(pid):
+        (kind, dtype, shape, order, offset) = pid
+        if kind != "ndarray":
+            raise pickle.UnpicklingError("Unknown reference %s in model" % kind)
+        dtype = numpy.dtype(dtype)
+        count = 1
+        for dim in shape:
+            count *= dim
+        array = numpy.frombuffer(buf, dtype=dtype, count=count, offset=data_offset + offset)
+        if order == "F":
+            return array.reshape(shape[::-1]).T
+        return array.reshape(shape)
+
+    return persistent_load
+
 
 def default_accessor(m):
     return m.predict
@@ -41,11 +188,40 @@ class Model(AttributeGetter):
         self.accessor_func = accessor_func
         self.model_predict = None
         self.setup_func = setup_func
+        # large arrays are read only views of memory shared with other processes
+        self.shared = False
+        # number of dimensions of a sample -> number of dimensions of its prediction
+        self.prediction_ndims = dict()
+        # model calls predict_batch made one sample at a time after a batch call could not be used
+        self.fallback_calls = 0
         AttributeGetter.__init__(self, attributes)
 
     def setup(self, workspace):
         self.setup_func(self, workspace)
 
+    def share_memory(self):
+        """
+        Move the large numpy arrays of the model into shared memory, ahead of forking worker processes.  The arrays
+        become read only views of one mapping inherited by every worker, so no worker copies them and a worker
+        writing to one fails instead of silently getting its own copy.  Everything else is shared copy-on-write.
+
+        The inner model is replaced by a copy loaded from shared memory, and only once that copy loaded.  An agent
+        still holding a reference to the original inner model keeps its arrays alive, so the model then takes twice
+        the memory.
+        :return: self
+        """
+        if getattr(self, "shared", False):
+            return self
+        with tempfile.TemporaryFile(prefix="cogscale-model-", dir=_SHARED_MEMORY_DIR) as shared:
+            self.write_container(self.model, shared)
+            shared.flush()
+            # the mapping outlives the file, which is already unlinked
+            mapped = mmap.mmap(shared.fileno(), 0, access=mmap.ACCESS_READ)
+        self.model = self.loads(mapped)
+        self.model_predict = None
+        self.shared = True
+        return self
+
     def predict_single(self, x):
         many = self.predict_many([x])
         return next(many)
@@ -55,26 +231,188 @@ class Model(AttributeGetter):
             self.model_predict = self.accessor_func(self.model)
         return (self.model_predict(x) for x in x_s)
 
+    def predict_batch(self, x_s):
+        """
+        Predict many samples with a single model call, i.e. one scikit-learn predict over a 2-D array.
+        :param x_s: list of samples, each one as it would be passed to predict_single
+        :return: list with one prediction per sample, each shaped like the result of predict_single
+
+        Samples are stacked into one array and the model output is split back into one row per sample.  A sample
+        gets its row's element, or a one row slice when predict_single returns as many dimensions as the batch output.
+        Which one is learnt from one predict_single call per number of sample dimensions.  When the samples cannot be
+        stacked, the batch call fails or its output cannot be split, the failure is logged and each sample is predicted
+        on its own instead, those calls are counted in fallback_calls.
+        """
+        x_s = list(x_s)
+        if self.model_predict is None:
+            self.model_predict = self.accessor_func(self.model)
+        if numpy is not None and len(x_s) > 1:
+            try:
+                results = self.model_predict(numpy.vstack(x_s))
+                if len(results) != len(x_s):
+                    raise ValueError("%d predictions for %d samples" % (len(results), len(x_s)))
+                return [self._split_prediction(results, i, x) for (i, x) in enumerate(x_s)]
+            except Exception:
+                log.exception("Unable to predict a batch of %d samples with model %s, predicting them one at a time"
+                              % (len(x_s), self.model_id))
+            self.fallback_calls = getattr(self, "fallback_calls", 0) + len(x_s)
+        return list(self.predict_many(x_s))
+
+    def _split_prediction(self, results, i, x):
+        prediction_ndims = getattr(self, "prediction_ndims", None)
+        if prediction_ndims is None:
+            prediction_ndims = self.prediction_ndims = dict()
+        sample_ndim = numpy.ndim(x)
+        if sample_ndim not in prediction_ndims:
+            prediction_ndims[sample_ndim] = numpy.ndim(self.model_predict(x))
+        if prediction_ndims[sample_ndim] == numpy.ndim(results):
+            return results[i:i + 1]
+        if prediction_ndims[sample_ndim] == numpy.ndim(results) - 1:
+            return results[i]
+        raise ValueError("Predictions of %d-D samples cannot be split from a %d-D batch prediction"
+                         % (sample_ndim, numpy.ndim(results)))
+
     @classmethod
     def dumps(cls, model):
         return cloudpickle.dumps(model)
 
     @classmethod
-    def dump(cls, model, workspace_root, model_name="model.bin"):
-        with open(path.join(workspace_root, model_name), mode="w") as model_file:
-            model_file.write(cls.dumps(model))
+    def serialize(cls, model):
+        return base64.b64encode(cls.dumps(model))
+
+    @classmethod
+    def deserialize(cls, model_str):
+        """
+        :param model_str: base64 encoded model, as sent in a START payload
+        """
+        return cls.loads(base64.b64decode(model_str))
+
+    @classmethod
+    def dump(cls, model, workspace_root, model_name="model.bin", codec=compression.NONE, level=None):
+        """
+        Write model in the model.bin container, large numpy arrays are stored out of the pickle so load can map
+        them instead of copying them
+        :param codec: "zlib", "zstd" or "lz4" to compress the model, which makes it smaller to store and move
+         around but means load has to decompress the arrays instead of mapping them
+        :param level: compression level of the codec
+        """
+        with open(path.join(workspace_root, model_name), mode="wb") as model_file:
+            cls.write_container(model, model_file, codec, level)
+
+    @classmethod
+    def write_container(cls, model, out, codec=compression.NONE, level=None):
+        """
+        :param out: seekable file, the header is rewritten once the stored sizes are known
+        """
+        pickled = StringIO()
+        pickler = _ModelPickler(pickled)
+        pickler.dump(model)
+        pickled = pickled.getvalue()
+        compressed = codec != compression.NONE
+        if compressed:
+            compressor = compression.compressor(codec, level)
+            stored_pickle = compressor.compress(pickled) + compressor.flush()
+            compressor = compression.compressor(codec, level)
+        else:
+            stored_pickle = pickled
+        start = out.tell()
+        out.write(_HEADER.pack(MODEL_MAGIC, MODEL_FORMAT_VERSION, compression.CODEC_IDS[codec], 0, 0, 0, 0))
+        out.write(stored_pickle)
+        data_start = _aligned(_HEADER.size + len(stored_pickle))
+        out.write("\0" * (data_start - _HEADER.size - len(stored_pickle)))
+        data_length = 0
+        stored_data_length = 0
+        for (offset, array) in pickler.arrays:
+            chunks = ["\0" * (offset - data_length)]
+            chunks.extend(buffer(array, position, compression.CHUNK_BYTES)
+                          for position in xrange(0, array.nbytes, compression.CHUNK_BYTES))
+            for chunk in chunks:
+                if compressed:
+                    chunk = compressor.compress(chunk)
+                out.write(chunk)
+                stored_data_length += len(chunk)
+            data_length = offset + array.nbytes
+        if compressed:
+            chunk = compressor.flush()
+            out.write(chunk)
+            stored_data_length += len(chunk)
+        end = out.tell()
+        out.seek(start)
+        out.write(_HEADER.pack(MODEL_MAGIC, MODEL_FORMAT_VERSION, compression.CODEC_IDS[codec], len(pickled),
+                               len(stored_pickle), data_length, stored_data_length))
+        out.seek(end)
 
     @classmethod
     def load(cls, workspace_path, model_name="model.bin"):
-        with open(path.join(workspace_path, model_name), "r") as model_file:
-            model_str = model_file.readlines()
-            model_bin = cls.loads("".join(model_str))
-        return model_bin
+        """
+        Load a model written by dump.  The file is memory mapped read only and arrays stored out of the pickle
+        become read only views of the mapping, so the pages are shared with the page cache (and any other process
+        loading the same file) rather than copied onto the heap.
+
+        A compressed model is decompressed as it is unpickled, its arrays straight into the one buffer they are
+        views of.
+        """
+        with open(path.join(workspace_path, model_name), "rb") as model_file:
+            if cls.is_compressed(model_file.read(_HEADER.size)):
+                # read rather than mapped, every mapped page of the compressed file would count in the RSS
+                return cls._load_compressed(model_file)
+            mapped = mmap.mmap(model_file.fileno(), 0, access=mmap.ACCESS_READ)
+        model = cls.loads(mapped)
+        if isinstance(model, Model) and mapped[:len(MODEL_MAGIC)] == MODEL_MAGIC:
+            # the mapped file is already shared with every process that loads it
+            model.shared = True
+        return model
 
     @classmethod
     def loads(cls, model_str):
-        model = cloudpickle.loads(model_str)
-        return model
+        """
+        :param model_str: string or buffer (i.e. an mmap) holding either the model.bin container or a plain pickle
+        """
+        if model_str[:len(MODEL_MAGIC)] != MODEL_MAGIC:
+            if isinstance(model_str, mmap.mmap):
+                # unpickle straight from the mapping rather than from a copy of it
+                return cPickle.Unpickler(model_str).load()
+            return cPickle.loads(model_str)
+        (magic, version) = struct.unpack("<4sH", model_str[:6])
+        if version != MODEL_FORMAT_VERSION:
+            raise pickle.UnpicklingError("Model format version %d is not supported by this SDK (%d)" % (
+                version, MODEL_FORMAT_VERSION))
+        if cls.is_compressed(model_str):
+            return cls._load_compressed(model_str if isinstance(model_str, mmap.mmap) else StringIO(model_str))
+        (_, _, _, pickle_length, stored_pickle_length, _, _) = _HEADER.unpack(model_str[:_HEADER.size])
+        data_offset = _aligned(_HEADER.size + stored_pickle_length)
+        unpickler = cPickle.Unpickler(StringIO(model_str[_HEADER.size:_HEADER.size + pickle_length]))
+        unpickler.persistent_load = _array_loader(model_str, data_offset)
+        return unpickler.load()
+
+    @staticmethod
+    def _load_compressed(source):
+        """
+        :param source: file (or mmap) holding a compressed container
+        """
+        source.seek(0)
+        (_, _, codec_id, pickle_length, stored_pickle_length, data_length, stored_data_length) = \
+            _HEADER.unpack(source.read(_HEADER.size))
+        codec = compression.CODEC_NAMES.get(codec_id)
+        if codec is None:
+            raise pickle.UnpicklingError("Unknown model compression codec %d" % codec_id)
+        chunks = compression.iter_decompress(codec, _section(source, _HEADER.size, stored_pickle_length))
+        unpickler = cPickle.Unpickler(_DecompressingReader(chunks))
+        if data_length:
+            data_offset = _aligned(_HEADER.size + stored_pickle_length)
+            chunks = compression.iter_decompress(codec, _section(source, data_offset, stored_data_length))
+            unpickler.persistent_load = _array_loader(_decompress_data(chunks, data_length), 0)
+        return unpickler.load()
+
+    @staticmethod
+    def is_compressed(model_str):
+        """
+        :param model_str: model or at least its first 8 bytes
+        """
+        if model_str[:len(MODEL_MAGIC)] != MODEL_MAGIC:
+            return False
+        (magic, version, codec_id) = struct.unpack("<4sHH", model_str[:8])
+        return codec_id != compression.CODEC_IDS[compression.NONE]
 
 
 class ModelMetadata(AttributeGetter):
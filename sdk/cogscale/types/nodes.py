@@ -15,7 +15,7 @@
 #
 
 import json
-from cogscale.types.fields import BaseField
+from cogscale.types.fields import FieldLayoutMeta, field_layout
 from cogscale.types.graph import GraphBuilder
 from cogscale.util.attribute_getter import AttributeGetter
 from cogscale.util.utils import json_encode
@@ -24,22 +24,18 @@ _DEFAULT_TYPE_URI = 'http://i6s.io/types/SubGraph'
 
 
 class Node(AttributeGetter):
+    __metaclass__ = FieldLayoutMeta
 
     meta = {'searchable': False, 'type_uri': _DEFAULT_TYPE_URI}
 
     def __init__(self, *args, **kwargs):
-        for key, val in self.__class__.__dict__.iteritems():
-            if isinstance(val, BaseField):
-                val.name = key
+        # names the fields of the class
+        field_layout(self.__class__)
 
         AttributeGetter.__init__(self, kwargs)
 
     def __repr__(self, detail_list=None):
-        detail_list = []
-        for key, val in self.__class__.__dict__.iteritems():
-            if isinstance(val, BaseField):
-                detail_list.append(key)
-        return AttributeGetter.__repr__(self, detail_list)
+        return AttributeGetter.__repr__(self, field_layout(self.__class__).names)
 
     def to_json(self, indent=None):
         return json.dumps(self, indent=indent, sort_keys=True, default=json_encode)
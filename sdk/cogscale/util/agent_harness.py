@@ -25,8 +25,12 @@ from cogscale.types.records import UnitOfWork
 from cogscale.types.models import Model
 from cogscale.util.utils import denormalize
 from cogscale.util.service_clients import DssClient, ModelRegistryClient
+from cogscale.util.workers import WORKER_MODES, THREAD_WORKERS
+from cogscale.util.profiling import Profiler, PROFILE_MODES, SAMPLING
+from cogscale.util import tracing
 from cogscale.util.parsers import AgentsParser
 import click
+from functools import wraps
 from os.path import splitext
 import yaml
 import logging
@@ -53,7 +57,79 @@ def cli():
     pass
 
 
+def profiled(command):
+    """
+    Add --profile, --profile-output and --flamegraph to a harness command to profile its whole run
+    """
+
+    @click.option("--flamegraph", type=click.Path(dir_okay=False, writable=True),
+                  help="Write sampled stacks in collapsed format (flamegraph.pl, speedscope) to this file.")
+    @click.option("--profile-output", type=click.File(mode='w'),
+                  help="File the profile report is written to, defaults to STDERR.")
+    @click.option("--profile", type=click.Choice(PROFILE_MODES),
+                  help="Profile the run, sampling has a low overhead while deterministic counts every call.")
+    @wraps(command)
+    def wrapper(*args, **kwargs):
+        mode = kwargs.pop("profile")
+        output = kwargs.pop("profile_output")
+        flamegraph = kwargs.pop("flamegraph")
+        if mode is None and flamegraph is None:
+            return command(*args, **kwargs)
+        profiler = Profiler(mode or SAMPLING, stacks=flamegraph is not None)
+        profiler.start()
+        try:
+            return command(*args, **kwargs)
+        finally:
+            profiler.stop()
+            # STDOUT is the pipe in pipe mode
+            profiler.write_report(output or sys.stderr)
+            if flamegraph is not None:
+                profiler.write_flamegraph(flamegraph)
+                log.info("Wrote flame graph stacks to %s" % flamegraph)
+    return wrapper
+
+
+def traced(command):
+    """
+    Add --trace to a harness command to record a Chrome trace of its whole run
+    """
+
+    @click.option("--trace", type=click.Path(dir_okay=False, writable=True),
+                  help="Write a Chrome trace event file (chrome://tracing, Perfetto) of agent and pipe spans.")
+    @wraps(command)
+    def wrapper(*args, **kwargs):
+        path = kwargs.pop("trace")
+        if path is None:
+            return command(*args, **kwargs)
+        tracing.enable(path)
+        try:
+            return command(*args, **kwargs)
+        finally:
+            log.info("Wrote trace to %s" % tracing.disable())
+    return wrapper
+
+
+def piped(command):
+    """
+    Add --writer-queue and --warmup to a pipe runner command, which gets the warmup file loaded as a START payload
+    """
+
+    @click.option("--warmup", type=click.File(),
+                  help="JSON file with a START payload minus its data (config and models) to set the agent up with "
+                       "before the first START.")
+    @click.option("--writer-queue", type=click.INT,
+                  help="In pipe mode, write messages from a background thread through a queue of this many messages.")
+    @wraps(command)
+    def wrapper(*args, **kwargs):
+        warmup = kwargs.pop("warmup")
+        kwargs["warmup"] = json.load(warmup) if warmup is not None else None
+        return command(*args, **kwargs)
+    return wrapper
+
+
 @cli.command()
+@profiled
+@traced
 @click.option("--requests", type=click.File())
 @click.option("--query")
 @click.option("--verbose", is_flag=True)
@@ -85,6 +161,8 @@ def insight(python_file_or_module, name, config, requests, query=None, verbose=F
 
 
 @cli.command()
+@profiled
+@traced
 @click.option("--requests", type=click.File())
 @click.option("--data", type=click.File(), help="Data to pass to the agent.  Used en lieu of a dss query")
 @click.option("--dss", help="specify a Data Subscription Service to call for input data")
@@ -132,6 +210,9 @@ def insight2(python_file_or_module, name, config, requests, dss=None, data=None,
 
 
 @cli.command()
+@profiled
+@traced
+@piped
 @click.option("--output", help="Output file path", type=click.File(mode='w'), default="records.json")
 @click.option("--verbose", is_flag=True)
 @click.option("--config", help="Json string representing the activation configuration.")
@@ -142,7 +223,8 @@ def insight2(python_file_or_module, name, config, requests, dss=None, data=None,
 @click.option("--limit", help="Limit the number of records retrieved.", type=click.INT)
 @click.argument("python_file_or_module", type=click.Path(file_okay=True, dir_okay=False, readable=True))
 @click.argument("name")
-def source(python_file_or_module, name, pipe, config=None, config_file=None, limit=None, output=None, verbose=False):
+def source(python_file_or_module, name, pipe, config=None, config_file=None, limit=None, output=None, verbose=False,
+           writer_queue=None, warmup=None):
     if verbose:
         log.setLevel(logging.DEBUG)
     load_module(python_file_or_module)
@@ -151,7 +233,7 @@ def source(python_file_or_module, name, pipe, config=None, config_file=None, lim
     process = SourcingProcess(environment)
 
     if pipe:
-        pipe = MessagePipe()
+        pipe = MessagePipe(writer_queue_size=writer_queue)
     else:
         log.info("Storing sourcing agent output in %s" % output)
         context = load_config("sources", name, config, config_file)
@@ -163,10 +245,13 @@ def source(python_file_or_module, name, pipe, config=None, config_file=None, lim
         from threading import Thread
         Thread(target=wait_for_complete, name="wait_for_sourcing").start()
 
-    PipeRunner(pipe=pipe, process=process).start()
+    PipeRunner(pipe=pipe, process=process, warmup=warmup).start()
 
 
 @cli.command()
+@profiled
+@traced
+@piped
 @click.option("--data", type=click.File(), help="specify a file with data en lieu of using DSS")
 @click.option("--output", help="Output file path", type=click.File(mode='w'), default="enrichments.json")
 @click.option("--verbose", is_flag=True)
@@ -183,14 +268,15 @@ def source(python_file_or_module, name, pipe, config=None, config_file=None, lim
 @click.argument("name")
 def enrich(python_file_or_module, name, config, data, pipe, workspace, dss=None, config_file=None, limit=None,
            output=None,
-           verbose=False):
+           verbose=False, writer_queue=None, warmup=None):
     if verbose:
         log.setLevel(logging.DEBUG)
     load_module(python_file_or_module)
     environment = AgentEnvironment(name, enrich_func, initial_context=dict())
 
     if pipe:
-        PipeRunner(process=EnrichmentProcess(environment)).start()
+        PipeRunner(pipe=MessagePipe(writer_queue_size=writer_queue), process=EnrichmentProcess(environment),
+                   warmup=warmup).start()
     else:
         context = load_config("enrichments", name, config, config_file, workspace)
         environment.context.update(context)
@@ -217,6 +303,9 @@ def enrich(python_file_or_module, name, config, data, pipe, workspace, dss=None,
 
 
 @cli.command()
+@profiled
+@traced
+@piped
 @click.option("--data", type=click.File(), help="Data to pass to the agent.  Used en lieu of a dss query")
 @click.option("--pipe",
               help="operate in pipe mode receiving commands on STDIN and sending output to the --output option",
@@ -231,7 +320,8 @@ def enrich(python_file_or_module, name, config, data, pipe, workspace, dss=None,
 @click.option("--config-file", help="File containing activation configuration.")
 @click.argument("python_file_or_module", type=click.Path(file_okay=True, dir_okay=False, readable=True))
 @click.argument("name")
-def train(python_file_or_module, name, config, pipe, data, dss, config_file=None, workspace=None, verbose=False):
+def train(python_file_or_module, name, config, pipe, data, dss, config_file=None, workspace=None, verbose=False,
+          writer_queue=None, warmup=None):
     if verbose:
         log.setLevel(logging.DEBUG)
 
@@ -256,17 +346,22 @@ def train(python_file_or_module, name, config, pipe, data, dss, config_file=None
         pipe.send_start(dict(payload.items() + {"config": context}.items()))
         pipe.send_stop()
     else:
-        pipe = MessagePipe()
+        pipe = MessagePipe(writer_queue_size=writer_queue)
 
-    PipeRunner(pipe=pipe, process=LearningProcess(environment)).start()
+    PipeRunner(pipe=pipe, process=LearningProcess(environment), warmup=warmup).start()
 
 @cli.command()
+@profiled
+@traced
+@piped
 @click.option("--data", type=click.File(), help="specify a json file holding an array of data to send to the prediction function.")
 @click.option("--dss", help="specify a Data Subscription Service to call for input data", default="localhost:3380")
 @click.option("--query", help="specify a Data Subscription Service to call for input data")
 @click.option("--workspace", type=click.Path(exists=True, file_okay=False, dir_okay=True, readable=True, writable=True),
               help="Path of existing workspace for model data", default="/tmp")
-@click.option("--model", help="specify a model url to load a model from a model registry.  Used with --registry")
+@click.option("--model", help="specify a model url to load a model from a model registry.  Used with --registry.  Models "
+                                "are kept in the local model store at $CS_MODEL_STORE (~/.cache/cogscale/models by "
+                                "default) and only downloaded once.")
 @click.option("--registry", help="specify a model registry host and port from which to load models.  Used with --model", default="localhost:3125")
 @click.option("--output", help="Output file path", type=click.File(mode='w'), default="-")
 @click.option("--verbose", "-v", is_flag=True)
@@ -274,9 +369,19 @@ def train(python_file_or_module, name, config, pipe, data, dss, config_file=None
               help="operate in pipe mode receiving commands on STDIN and sending output to the --output option",
               is_flag=True)
 @click.option("--limit", help="Limit the number of predicted records.", type=click.INT)
+@click.option("--workers", help="Number of predictions to run concurrently.", type=click.INT, default=1)
+@click.option("--worker-mode", type=click.Choice(WORKER_MODES), default=THREAD_WORKERS,
+              help="Run concurrent predictions on threads (I/O bound agents) or processes (CPU bound agents).")
+@click.option("--cache-size", type=click.INT,
+              help="Answer repeated values from a cache of this many predictions.")
+@click.option("--cache-ttl", type=click.FLOAT, help="Seconds a cached prediction is served for.")
+@click.option("--micro-batch", is_flag=True,
+              help="With several thread workers, batch the predict_single calls the agent makes on its models.")
 @click.argument("python_file_or_module", type=click.Path(file_okay=True, dir_okay=False, readable=True))
 @click.argument("name")
-def predict(python_file_or_module, name, data, workspace, query=None, dss=None, registry=None, model=None, limit=None, output=None, verbose=False, pipe=False):
+def predict(python_file_or_module, name, data, workspace, query=None, dss=None, registry=None, model=None, limit=None, output=None, verbose=False, pipe=False,
+            writer_queue=None, workers=1, worker_mode=THREAD_WORKERS, warmup=None, cache_size=None, cache_ttl=None,
+            micro_batch=False):
     if verbose:
         log.setLevel(logging.DEBUG)
 
@@ -291,6 +396,7 @@ def predict(python_file_or_module, name, data, workspace, query=None, dss=None,
             if slug is None and timestamp is None:
                 raise Exception("Invalid model url for slug %s and timestamp %s", (slug, timestamp))
             model_client = ModelRegistryClient(registry)
+            # only downloaded when the version is not in the local model store yet
             metadata = model_client.retrieve_model(slug, timestamp, workspace)
             log.info("Loaded model to %s with metadata: %s" % (workspace, metadata))
         else:
@@ -311,12 +417,17 @@ def predict(python_file_or_module, name, data, workspace, query=None, dss=None,
         pipe.send_stop()
 
     else:
-        pipe = MessagePipe()
+        pipe = MessagePipe(writer_queue_size=writer_queue)
 
-    PipeRunner(pipe=pipe, process=PredictionProcess(environment)).start()
+    process = PredictionProcess(environment, workers=workers, worker_mode=worker_mode, cache_size=cache_size,
+                                cache_ttl=cache_ttl, micro_batch=micro_batch)
+    PipeRunner(pipe=pipe, process=process, warmup=warmup).start()
 
 
 @cli.command()
+@profiled
+@traced
+@piped
 @click.option("--data", type=click.File())
 @click.option("--verbose", is_flag=True)
 @click.option("--output", help="Output file path", type=click.File(mode='w'), default="status.json")
@@ -330,7 +441,7 @@ def predict(python_file_or_module, name, data, workspace, query=None, dss=None,
 @click.argument("python_file_or_module", type=click.Path(file_okay=True, dir_okay=False, readable=True))
 @click.argument("name")
 def publish(python_file_or_module, name, config, data, pipe, limit=None, output=None, dss=None, config_file=None,
-            verbose=False):
+            verbose=False, writer_queue=None, warmup=None):
 
     if verbose:
         log.setLevel(logging.DEBUG)
@@ -356,9 +467,9 @@ def publish(python_file_or_module, name, config, data, pipe, limit=None, output=
         pipe = HarnessPipe(output_file=output)
         pipe.send_start(dict(payload.items() + {"config": context, "limit": limit}.items()))
     else:
-        pipe = MessagePipe()
+        pipe = MessagePipe(writer_queue_size=writer_queue)
 
-    PipeRunner(pipe=pipe, process=PublishProcess(environment)).start()
+    PipeRunner(pipe=pipe, process=PublishProcess(environment), warmup=warmup).start()
 
 
 def load_module(python_file_or_module):
@@ -405,9 +516,7 @@ def process_models(config):
     workspace_root = config.get("workspace")
     model_keys = BaseProcess.keys_with_value_type(config, "model")
     for (name, path) in [(k, v[6:].strip()) for k, v in config.iteritems() if (k in model_keys)]:
-        model_path = "%s/%s/model.bin" % (workspace_root, path)
-        workspace_path = "%s/%s/workspace" % (workspace_root, path)
-        results[name] = Model.load(model_path, workspace_path)
+        results[name] = Model.load("%s/%s" % (workspace_root, path))
     return results
 
 
@@ -436,20 +545,25 @@ def load_data(data, param="data"):
     return payload
 
 
-class HarnessPipe(object):
-    import sys
+class HarnessPipe(MessagePipe):
     def __init__(self, output_file=None):
-        self.output = output_file or sys.stdout
+        super(HarnessPipe, self).__init__(input=None, output=output_file or sys.stdout)
         self.commands = Queue()
 
     def on_data(self, obj):
-        self.output.write(encode(obj, unpicklable=False))
+        self.output.write(self.encode_payload(obj))
         self.output.write("\n")
 
     def send(self, obj):
         if obj.get("response") == "DATA":
             self.on_data(obj.get("payload"))
 
+    def send_batch(self, response, fragments):
+        if response == "DATA":
+            for fragment in fragments:
+                self.output.write(fragment)
+                self.output.write("\n")
+
     def receive(self):
         return self.commands.get(block=True)
 
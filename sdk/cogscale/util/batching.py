@@ -0,0 +1,264 @@
+#
+# Copyright 2016 CognitiveScale, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+import os
+import sys
+import time
+from Queue import Queue, Empty
+from threading import Thread, Event, Lock
+
+DEFAULT_BATCH_RECORDS = 500
+DEFAULT_BATCH_BYTES = 1024 * 1024
+DEFAULT_BATCH_LATENCY_MS = 250
+DEFAULT_MICRO_BATCH_SIZE = 64
+DEFAULT_MICRO_BATCH_WAIT_MS = 2
+DEFAULT_MICRO_BATCH_TARGET_MS = 50
+
+
+class DataBatcher(object):
+    """
+    Coalesces DATA payloads into messages of the form {"response": "DATA", "payload": {"body": [...]}}.
+
+    A batch is flushed once it holds max_records payloads, max_bytes of encoded payloads or has been open for
+    max_latency seconds, whichever comes first.  Payloads are encoded as they are added so a record that cannot be
+    encoded fails on its own add call.  A batcher built without limits sends each payload as its own DATA message.
+
+    When a batch cannot be sent, the add call that flushed it raises and its payload is lost along with the
+    payloads of earlier add calls that had already returned.  Those are reported to the failed callback, so callers
+    counting a record once add returns can count them again as excluded.
+    """
+
+    def __init__(self, pipe, max_records=1, max_bytes=None, max_latency=None, failed=None):
+        """
+        :param failed: failed(count) is called with the number of payloads of earlier add calls lost with a batch
+        """
+        self.log = logging.getLogger()
+        self.pipe = pipe
+        self.failed = failed
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.max_latency = max_latency
+        self.enabled = max_records > 1
+        self.fragments = []
+        self.size = 0
+        self.opened = None
+        self.lock = Lock()
+        self.closed = Event()
+        self.timer = None
+        if self.enabled and max_latency:
+            self.timer = Thread(target=self._flush_expired, name="data_batcher")
+            self.timer.daemon = True
+            self.timer.start()
+
+    @classmethod
+    def from_config(cls, pipe, config, failed=None):
+        """
+        Build a batcher from the "batch" object of a START payload
+        :param pipe: pipe the batches are sent on
+        :param config: {maxRecords:, maxBytes:, maxLatencyMs:} or None to send every payload on its own
+        :param failed: called with the number of payloads lost with a batch that could not be sent
+        :return: DataBatcher
+        """
+        if not config:
+            return cls(pipe, failed=failed)
+        max_latency_ms = config.get("maxLatencyMs", DEFAULT_BATCH_LATENCY_MS)
+        return cls(pipe,
+                   max_records=int(config.get("maxRecords", DEFAULT_BATCH_RECORDS)),
+                   max_bytes=config.get("maxBytes", DEFAULT_BATCH_BYTES),
+                   max_latency=max_latency_ms / 1000.0 if max_latency_ms else None,
+                   failed=failed)
+
+    def add(self, payload):
+        if not self.enabled:
+            self.pipe.send({"response": "DATA", "payload": payload})
+            return
+        fragment = self.pipe.encode_payload(payload)
+        with self.lock:
+            if not self.fragments:
+                self.opened = time.time()
+            self.fragments.append(fragment)
+            self.size += len(fragment)
+            if len(self.fragments) >= self.max_records or (self.max_bytes and self.size >= self.max_bytes):
+                self._flush(adding=True)
+
+    def flush(self):
+        with self.lock:
+            self._flush()
+
+    def close(self):
+        """
+        Send any pending payloads and stop the latency timer, closing again does nothing
+        """
+        self.closed.set()
+        if self.timer is not None:
+            self.timer.join()
+        self.flush()
+
+    def _flush(self, adding=False):
+        """
+        :param adding: flushing from add, its payload is the last one and it is not counted as lost
+        """
+        if not self.fragments:
+            return
+        fragments = self.fragments
+        self.fragments = []
+        self.size = 0
+        try:
+            self.pipe.send_batch("DATA", fragments)
+        except Exception:
+            lost = len(fragments) - 1 if adding else len(fragments)
+            if self.failed is not None and lost:
+                self.failed(lost)
+            raise
+
+    def _flush_expired(self):
+        while not self.closed.wait(self.max_latency / 2):
+            with self.lock:
+                if self.fragments and time.time() - self.opened >= self.max_latency:
+                    try:
+                        self._flush()
+                    except Exception:
+                        self.log.error("Unable to send a batch of DATA", exc_info=True)
+
+
+class _Prediction(object):
+    __slots__ = ["x", "submitted", "done", "result", "error"]
+
+    def __init__(self, x):
+        self.x = x
+        self.submitted = time.time()
+        self.done = Event()
+        self.result = None
+        self.error = None
+
+
+class MicroBatcher(object):
+    """
+    Stands in for a Model whose predict_single is called from many threads at once, i.e. by an agent running on
+    several prediction workers.  Concurrent calls are collected for up to max_wait seconds and run as one
+    Model.predict_batch call, each caller getting back its own prediction or exception.  Every other attribute is the
+    model's.  Calls made in a forked child, which has no dispatcher thread, go straight to the model.
+
+    The number of calls collected per batch adapts to the target latency, measured from the oldest call of a batch
+    being submitted to its batch completing: it grows by one after every full batch within the target and is halved
+    after every batch over it.
+    """
+
+    def __init__(self, model, max_batch_size=DEFAULT_MICRO_BATCH_SIZE, max_wait_ms=DEFAULT_MICRO_BATCH_WAIT_MS,
+                 target_latency_ms=DEFAULT_MICRO_BATCH_TARGET_MS):
+        """
+        :param model: Model to batch calls to
+        :param max_batch_size: upper bound of the adaptive batch size
+        :param max_wait_ms: longest a call waits for others to join its batch
+        :param target_latency_ms: latency the batch size is adapted to
+        """
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.target_latency = target_latency_ms / 1000.0
+        self.batch_size = 1
+        self.batches = 0
+        self.predictions = 0
+        self.pending = Queue()
+        self.lock = Lock()
+        self.closed = False
+        self.pid = os.getpid()
+        self.dispatcher = Thread(target=self._dispatch, name="micro_batcher")
+        self.dispatcher.daemon = True
+        self.dispatcher.start()
+
+    def __getattr__(self, name):
+        if name == "model":
+            raise AttributeError(name)
+        return getattr(self.model, name)
+
+    def predict_single(self, x):
+        if os.getpid() != self.pid:
+            return self.model.predict_single(x)
+        with self.lock:
+            if self.closed:
+                return self.model.predict_single(x)
+            prediction = _Prediction(x)
+            self.pending.put(prediction)
+        prediction.done.wait()
+        if prediction.error is not None:
+            raise prediction.error[0], prediction.error[1], prediction.error[2]
+        return prediction.result
+
+    def close(self):
+        """
+        Finish the calls already submitted, later calls go straight to the model
+        """
+        with self.lock:
+            if self.closed:
+                return
+            self.closed = True
+            self.pending.put(None)
+        self.dispatcher.join()
+
+    def stats(self):
+        return {"batches": self.batches,
+                "predictions": self.predictions,
+                "batchSize": self.batch_size,
+                "meanBatchSize": float(self.predictions) / self.batches if self.batches else 0.0,
+                "fallbackCalls": getattr(self.model, "fallback_calls", 0)}
+
+    def _dispatch(self):
+        while True:
+            prediction = self.pending.get()
+            if prediction is None:
+                return
+            batch = [prediction]
+            closing = False
+            deadline = prediction.submitted + self.max_wait
+            while len(batch) < self.batch_size:
+                wait = deadline - time.time()
+                try:
+                    prediction = self.pending.get(timeout=wait) if wait > 0 else self.pending.get_nowait()
+                except Empty:
+                    break
+                if prediction is None:
+                    closing = True
+                    break
+                batch.append(prediction)
+            self._run(batch)
+            if closing:
+                return
+
+    def _run(self, batch):
+        try:
+            results = self.model.predict_batch([prediction.x for prediction in batch])
+            for (prediction, result) in zip(batch, results):
+                prediction.result = result
+        except Exception:
+            # find out which calls failed
+            for prediction in batch:
+                try:
+                    prediction.result = self.model.predict_single(prediction.x)
+                except Exception:
+                    prediction.error = sys.exc_info()
+        self._adapt(len(batch), time.time() - batch[0].submitted)
+        for prediction in batch:
+            prediction.done.set()
+
+    def _adapt(self, size, latency):
+        self.batches += 1
+        self.predictions += size
+        if latency > self.target_latency:
+            self.batch_size = max(1, self.batch_size // 2)
+        elif size >= self.batch_size:
+            self.batch_size = min(self.max_batch_size, self.batch_size + 1)
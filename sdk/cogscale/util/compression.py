@@ -0,0 +1,131 @@
+#
+# Copyright 2016 CognitiveScale, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Streaming compression behind one interface: compressor(codec).compress(data) / flush() to compress and
+iter_decompress(codec, read) to decompress.  zlib is always available, zstd needs the zstandard package and lz4 the
+lz4 package.
+"""
+
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import lz4.frame as lz4_frame
+except ImportError:
+    lz4_frame = None
+
+NONE = "none"
+ZLIB = "zlib"
+ZSTD = "zstd"
+LZ4 = "lz4"
+# stored in file headers, never renumber
+CODEC_IDS = {NONE: 0, ZLIB: 1, ZSTD: 2, LZ4: 3}
+CODEC_NAMES = dict((codec_id, name) for (name, codec_id) in CODEC_IDS.iteritems())
+CHUNK_BYTES = 1024 * 1024
+_PACKAGES = {ZSTD: "zstandard", LZ4: "lz4"}
+
+
+def available_codecs():
+    return [name for name in sorted(CODEC_IDS) if _installed(name)]
+
+
+def _installed(codec):
+    if codec == ZSTD:
+        return zstandard is not None
+    if codec == LZ4:
+        return lz4_frame is not None
+    return True
+
+
+def _check(codec):
+    if codec not in CODEC_IDS or codec == NONE:
+        raise ValueError("Unknown compression codec %s, expected one of %s" % (codec, sorted(CODEC_IDS)))
+    if not _installed(codec):
+        raise ImportError("The %s codec needs the %s package" % (codec, _PACKAGES[codec]))
+
+
+class _Lz4Compressor(object):
+    def __init__(self, level):
+        self.compressor = lz4_frame.LZ4FrameCompressor(compression_level=level or 0)
+        self.started = False
+
+    def _begin(self):
+        if self.started:
+            return ""
+        self.started = True
+        return self.compressor.begin()
+
+    def compress(self, data):
+        return self._begin() + self.compressor.compress(data)
+
+    def flush(self):
+        return self._begin() + self.compressor.flush()
+
+
+def compressor(codec, level=None):
+    """
+    :param level: codec specific compression level, None for the codec's default
+    """
+    _check(codec)
+    if codec == ZLIB:
+        return zlib.compressobj(level if level is not None else zlib.Z_DEFAULT_COMPRESSION)
+    if codec == ZSTD:
+        return zstandard.ZstdCompressor(level=level if level is not None else 3).compressobj()
+    return _Lz4Compressor(level)
+
+
+class _Reader(object):
+    def __init__(self, read):
+        self.read = read
+
+
+def iter_decompress(codec, read, size=CHUNK_BYTES):
+    """
+    Decompress a stream into chunks of at most size bytes, so highly compressed data never expands into one large
+    string
+    :param read: read(n) returns up to n more compressed bytes, an empty string at the end
+    """
+    _check(codec)
+    if codec == ZSTD:
+        for chunk in zstandard.ZstdDecompressor().read_to_iter(_Reader(read), read_size=size, write_size=size):
+            yield chunk
+        return
+    if codec == ZLIB:
+        decompressor = zlib.decompressobj()
+        for data in iter(lambda: read(size), ""):
+            while data:
+                chunk = decompressor.decompress(data, size)
+                if chunk:
+                    yield chunk
+                data = decompressor.unconsumed_tail
+        chunk = decompressor.flush()
+        if chunk:
+            yield chunk
+        return
+    decompressor = lz4_frame.LZ4FrameDecompressor()
+    for data in iter(lambda: read(size), ""):
+        chunk = decompressor.decompress(data, max_length=size)
+        while True:
+            if chunk:
+                yield chunk
+            if decompressor.needs_input or decompressor.eof:
+                break
+            chunk = decompressor.decompress("", max_length=size)
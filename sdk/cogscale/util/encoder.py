@@ -14,8 +14,13 @@
 # limitations under the License.
 #
 
+import threading
+import types
 from json import JSONEncoder
+
+from jsonpickle import json as jsonpickle_backend, handlers as json_handlers, tags, util as jsonpickle_util
 from jsonpickle.handlers import BaseHandler
+from jsonpickle.pickler import Pickler
 
 
 class ResultEncoder(JSONEncoder):
@@ -32,4 +37,118 @@ class ResultEncoder(JSONEncoder):
 
 class Iso8601Handler(BaseHandler):
     def flatten(self, obj, data):
-        return obj.isoformat()
\ No newline at end of file
+        return obj.isoformat()
+
+_PRIMITIVES = frozenset([type(None), bool, int, long, float, unicode])
+_SEQUENCES = frozenset([list, tuple, set])
+_FUNCTIONS = frozenset([types.FunctionType, types.MethodType, types.BuiltinFunctionType, type(object().__str__)])
+_MAX_KEY_ORDERS = 4096
+
+
+class RecordEncoder(object):
+    """
+    Encodes objects to the same JSON as jsonpickle's encode(obj, unpicklable=False) without its reflective walk.
+
+    The first time an instance of a class is seen a flattener is compiled for that class: plain classes are flattened
+    straight from their __dict__, classes with a registered jsonpickle handler (i.e. Iso8601Handler for datetime) call
+    the handler and anything jsonpickle treats specially (__getstate__, __reduce__, slots, iterators, ...) is handed
+    to jsonpickle itself.  Sorted key orders are cached per key layout, so records sharing a shape are not re-sorted.
+    Handlers must be registered before the first object of their class is encoded.
+    """
+
+    def __init__(self):
+        self.class_flatteners = dict()
+        self.key_orders = dict()
+        self.local = threading.local()
+        self.dispatch = {dict: self._flatten_dict, str: self._flatten_bytes, types.InstanceType: self._flatten_instance}
+        for sequence_type in _SEQUENCES:
+            self.dispatch[sequence_type] = self._flatten_sequence
+
+    def encode(self, obj):
+        return jsonpickle_backend.encode(self.flatten(obj))
+
+    def flatten(self, obj):
+        obj_type = type(obj)
+        if obj_type in _PRIMITIVES:
+            return obj
+        flatten = self.dispatch.get(obj_type)
+        if flatten is None:
+            flatten = self._compile(obj)
+            self.dispatch[obj_type] = flatten
+        return flatten(obj)
+
+    def _flatten_instance(self, obj):
+        # old style instances all share one type so they are compiled by class instead
+        flatten = self.class_flatteners.get(obj.__class__)
+        if flatten is None:
+            flatten = self._compile(obj)
+            self.class_flatteners[obj.__class__] = flatten
+        return flatten(obj)
+
+    def _flatten_sequence(self, obj):
+        return [self.flatten(v) for v in obj]
+
+    def _flatten_bytes(self, obj):
+        try:
+            return obj.decode('utf-8')
+        except UnicodeDecodeError:
+            return self._flatten_fallback(obj)
+
+    def _flatten_dict(self, obj):
+        data = {}
+        for k in self._sorted_keys(obj):
+            v = obj[k]
+            if k in tags.RESERVED or (type(v) in _FUNCTIONS and not jsonpickle_util.is_picklable(k, v)):
+                continue
+            if k is None:
+                k = 'null'
+            elif not isinstance(k, basestring):
+                k = repr(k)
+            data[k] = self.flatten(v)
+        return data
+
+    def _sorted_keys(self, obj):
+        layout = tuple(obj)
+        keys = self.key_orders.get(layout)
+        if keys is None:
+            keys = sorted(layout, key=unicode)
+            if len(self.key_orders) < _MAX_KEY_ORDERS:
+                self.key_orders[layout] = keys
+        return keys
+
+    def _flatten_fallback(self, obj):
+        return self._pickler().flatten(obj)
+
+    def _pickler(self):
+        pickler = getattr(self.local, "pickler", None)
+        if pickler is None:
+            pickler = self.local.pickler = Pickler(unpicklable=False)
+        return pickler
+
+    def _compile(self, obj):
+        cls = getattr(obj, '__class__', type(obj))
+        handler = json_handlers.get(cls, json_handlers.get(jsonpickle_util.importable_name(cls)))
+        if handler is not None:
+            return lambda o: handler(self._pickler()).flatten(o, {})
+        if self._is_plain(obj):
+            return lambda o: self._flatten_dict(o.__dict__)
+        return self._flatten_fallback
+
+    @staticmethod
+    def _is_plain(obj):
+        """
+        True if jsonpickle would flatten obj by walking its __dict__
+        """
+        return (hasattr(obj, '__dict__') and
+                jsonpickle_util.is_object(obj) and
+                not jsonpickle_util.is_type(obj) and
+                not jsonpickle_util.is_module(obj) and
+                not jsonpickle_util.is_function(obj) and
+                not isinstance(obj, (dict, list, tuple, set, basestring, int, long, float)) and
+                not jsonpickle_util.is_sequence_subclass(obj) and
+                not jsonpickle_util.is_iterator(obj) and
+                not any(jsonpickle_util.has_reduce(obj)) and
+                not hasattr(obj, '__getstate__') and
+                not jsonpickle_util.has_method(obj, '__getnewargs__') and
+                not jsonpickle_util.has_method(obj, '__getnewargs_ex__') and
+                not jsonpickle_util.has_method(obj, '__getinitargs__'))
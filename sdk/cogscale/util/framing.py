@@ -0,0 +1,112 @@
+#
+# Copyright 2016 CognitiveScale, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import json
+import struct
+
+from cogscale.util.encoder import RecordEncoder
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+if msgpack is not None and msgpack.version < (0, 5, 2):
+    # releases before raw=False only read strings as utf-8 through the encoding argument msgpack 1.0 removed
+    msgpack = None
+
+JSON_FORMAT = "json"
+MSGPACK_FORMAT = "msgpack"
+
+# shared so classes are only compiled once per process
+_encoder = RecordEncoder()
+
+
+class JsonLineFraming(object):
+    """
+    One jsonpickle encoded message per line.  This is the default framing and is always available.
+    """
+
+    name = JSON_FORMAT
+
+    def encode(self, obj):
+        return _encoder.encode(obj) + "\n"
+
+    def encode_fragment(self, obj):
+        return _encoder.encode(obj)
+
+    def encode_batch(self, response, fragments):
+        return '{"response": %s, "payload": {"body": [%s]}}\n' % (json.dumps(response), ", ".join(fragments))
+
+    def read(self, input):
+        line = input.readline()
+        return json.loads(line.rstrip('\n'))
+
+
+class MsgpackFraming(object):
+    """
+    Length prefixed msgpack messages.  Each frame is a 4 byte big-endian length followed by the packed message.
+    Strings are packed as raw and read back as utf-8, which needs msgpack 0.5.2 or later.
+    """
+
+    name = MSGPACK_FORMAT
+    header = struct.Struct(">I")
+
+    def encode(self, obj):
+        return self._frame(self.encode_fragment(obj))
+
+    def encode_fragment(self, obj):
+        return msgpack.packb(_encoder.flatten(obj), use_bin_type=False)
+
+    def encode_batch(self, response, fragments):
+        packer = msgpack.Packer(use_bin_type=False)
+        return self._frame("".join([packer.pack_map_header(2),
+                                    packer.pack("response"), packer.pack(response),
+                                    packer.pack("payload"), packer.pack_map_header(1),
+                                    packer.pack("body"), packer.pack_array_header(len(fragments))] + fragments))
+
+    def _frame(self, packed):
+        return self.header.pack(len(packed)) + packed
+
+    def read(self, input):
+        (length,) = self.header.unpack(self._read_exactly(input, self.header.size))
+        return msgpack.unpackb(self._read_exactly(input, length), raw=False)
+
+    @staticmethod
+    def _read_exactly(input, size):
+        data = input.read(size)
+        if len(data) < size:
+            raise EOFError("pipe closed after %d of %d bytes" % (len(data), size))
+        return data
+
+
+_FRAMINGS = {JSON_FORMAT: JsonLineFraming}
+if msgpack is not None:
+    _FRAMINGS[MSGPACK_FORMAT] = MsgpackFraming
+
+
+def available_formats():
+    """
+    Names of the framings usable in this process, most preferred first.
+    :return: list of str
+    """
+    return sorted(_FRAMINGS.keys(), key=lambda name: name == JSON_FORMAT)
+
+
+def framing_for(name):
+    if name not in _FRAMINGS:
+        raise ValueError("Unsupported pipe format %s" % name)
+    return _FRAMINGS[name]()
@@ -0,0 +1,148 @@
+#
+# Copyright 2016 CognitiveScale, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import math
+import time
+from itertools import islice
+from threading import Lock
+
+# bucket bounds grow by 10% from 1 microsecond, which covers up to roughly an hour in a couple of hundred buckets
+MIN_SECONDS = 0.000001
+GROWTH = 1.1
+BUCKETS = 230
+_SCALE = 1 / MIN_SECONDS
+_INV_LOG_GROWTH = 1 / math.log(GROWTH)
+_log = math.log
+# per record timings only time one step in this many, the counts come from the status
+SAMPLE_EVERY = 16
+
+
+class Histogram(object):
+    """
+    Latency histogram over log scaled buckets.  Recording a duration is a couple of arithmetic operations so it is
+    cheap enough to call once per record, percentiles are accurate to the bucket width (10%).
+
+    record is not locked, the GIL keeps the buckets consistent and a sample lost to a race between two recording
+    threads does not matter for latency statistics.
+    """
+
+    def __init__(self):
+        self.buckets = [0] * BUCKETS
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds > MIN_SECONDS:
+            index = int(_log(seconds * _SCALE) * _INV_LOG_GROWTH) + 1
+            if index >= BUCKETS:
+                index = BUCKETS - 1
+        else:
+            index = 0
+        self.buckets[index] += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, fraction, buckets=None):
+        """
+        Upper bound of the bucket holding the given fraction of the samples, in seconds
+        """
+        buckets = buckets or list(self.buckets)
+        rank = fraction * sum(buckets)
+        seen = 0
+        for (index, count) in enumerate(buckets):
+            seen += count
+            if count and seen >= rank:
+                return min(MIN_SECONDS * GROWTH ** index, self.max)
+        return 0.0
+
+    def snapshot(self):
+        buckets = list(self.buckets)
+        count = sum(buckets)
+        return {"count": count,
+                "totalMs": self.total * 1000,
+                "meanMs": self.total * 1000 / count if count else 0.0,
+                "p50Ms": self.percentile(0.50, buckets) * 1000,
+                "p95Ms": self.percentile(0.95, buckets) * 1000,
+                "p99Ms": self.percentile(0.99, buckets) * 1000,
+                "maxMs": self.max * 1000}
+
+
+class Metrics(object):
+    """
+    Named latency histograms for one run of an agent (or for the life of a pipe).
+
+    Hot paths should keep the Histogram returned by timing() rather than look it up by name for every sample.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.started = time.time()
+        self.finished = None
+        self.timings = dict()
+
+    def timing(self, name):
+        with self.lock:
+            if name not in self.timings:
+                self.timings[name] = Histogram()
+            return self.timings[name]
+
+    def record(self, name, seconds):
+        self.timing(name).record(seconds)
+
+    def finish(self):
+        """
+        Stop the clock used for rates once the run is over
+        """
+        if self.finished is None:
+            self.finished = time.time()
+
+    def elapsed(self):
+        return (self.finished or time.time()) - self.started
+
+    def snapshot(self, **counters):
+        """
+        :param counters: counts kept by the caller (i.e. records from the status) to report along with their rates
+        :return: {elapsedSeconds:, counters: {name: value}, rates: {name: value per second}, timings: {name:
+         {count:, totalMs:, meanMs:, p50Ms:, p95Ms:, p99Ms:, maxMs:}}}
+        """
+        elapsed = self.elapsed()
+        with self.lock:
+            timings = dict(self.timings)
+        return {"elapsedSeconds": elapsed,
+                "counters": counters,
+                "rates": {name: value / elapsed if elapsed > 0 else 0.0 for (name, value) in counters.iteritems()},
+                "timings": {name: timing.snapshot() for (name, timing) in timings.iteritems()}}
+
+
+def timed_iter(iterable, timing, sample_every=SAMPLE_EVERY):
+    """
+    Iterate while recording how long steps of the underlying iterator (i.e. an agent's generator) take
+    :param iterable: records produced by an agent
+    :param timing: Histogram the sampled next() durations are recorded in
+    :param sample_every: time one step in this many
+    """
+    iterator = iter(iterable)
+    while True:
+        started = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        timing.record(time.time() - started)
+        yield item
+        for item in islice(iterator, sample_every - 1):
+            yield item
@@ -0,0 +1,91 @@
+#
+# Copyright 2016 CognitiveScale, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import logging
+from collections import OrderedDict
+from threading import Lock
+
+DEFAULT_MODEL_CACHE_BYTES = 2 * 1024 * 1024 * 1024
+
+
+class ModelCache(object):
+    """
+    Loaded models keyed by (config key, slug, timestamp), evicting the least recently used ones once their serialized
+    sizes add up to more than max_bytes.  The most recently used model is always kept, even when it alone is over
+    the limit.
+    """
+
+    def __init__(self, max_bytes=DEFAULT_MODEL_CACHE_BYTES):
+        self.log = logging.getLogger()
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        # (config key, slug, timestamp) -> (model, size), least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, version, load):
+        """
+        :param version: (config key, slug, timestamp) of the model, the config key keeps models without a version
+         apart
+        :param load: called on a miss, returns (model, size in bytes)
+        :return: the cached or newly loaded model
+        """
+        with self.lock:
+            entry = self.entries.pop(version, None)
+            if entry is not None:
+                self.entries[version] = entry
+                self.hits += 1
+                return entry[0]
+            self.misses += 1
+        # loading can take a while, other versions stay available meanwhile
+        (model, size) = load()
+        with self.lock:
+            if version not in self.entries:
+                self.entries[version] = (model, size)
+                self.bytes += size
+                self.evict()
+            return self.entries[version][0] if version in self.entries else model
+
+    def evict(self):
+        while self.bytes > self.max_bytes and len(self.entries) > 1:
+            (version, (model, size)) = self.entries.popitem(last=False)
+            self.bytes -= size
+            self.evictions += 1
+            self.log.info("evicted model %s %s:%s (%d bytes) from the model cache" % (version + (size,)))
+
+    def invalidate(self, version):
+        """
+        Drop a version that has been replaced, jobs already holding the model keep using it
+        """
+        with self.lock:
+            entry = self.entries.pop(version, None)
+            if entry is not None:
+                self.bytes -= entry[1]
+                self.invalidations += 1
+
+    def stats(self):
+        with self.lock:
+            return {"models": len(self.entries),
+                    "bytes": self.bytes,
+                    "maxBytes": self.max_bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "invalidations": self.invalidations}
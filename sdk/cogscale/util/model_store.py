@@ -0,0 +1,171 @@
+#
+# Copyright 2016 CognitiveScale, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import shutil
+import stat
+import tempfile
+import urllib
+import zipfile
+
+MODEL_STORE_ENV = "CS_MODEL_STORE"
+DEFAULT_MODEL_STORE = os.path.join("~", ".cache", "cogscale", "models")
+CHUNK_SIZE = 1024 * 1024
+
+
+class ModelStore(object):
+    """
+    Local cache of models retrieved from the model registry.  A version that has been retrieved once is served from
+    disk without contacting the registry.  Every file is written under a temporary name and renamed into place, so
+    interrupted downloads never leave a partial model behind.  A download holds an exclusive lock on its .lock file,
+    so concurrent harness runs retrieving the same version wait for the first one and then use its copy.
+
+        versions/<slug>/<timestamp>.json   {sha256:, metadata:} of a model version
+        downloads/<slug>@<timestamp>.part  download in progress, resumed by the next attempt
+        downloads/<slug>@<timestamp>.lock  held while downloading
+        blobs/<sha256>.zip                 downloaded archives
+        models/<sha256>/                   extracted archives, shared by versions with the same content
+
+    Extracted files are read only, workspaces hard link to them.
+    """
+
+    def __init__(self, root=None):
+        """
+        :param root: store directory, defaults to $CS_MODEL_STORE or ~/.cache/cogscale/models
+        """
+        self.log = logging.getLogger()
+        self.root = os.path.expanduser(root or os.environ.get(MODEL_STORE_ENV) or DEFAULT_MODEL_STORE)
+
+    @staticmethod
+    def _name(value):
+        return urllib.quote(str(value), safe="")
+
+    def _path(self, *parts):
+        path = os.path.join(self.root, *parts)
+        parent = os.path.dirname(path)
+        if not os.path.isdir(parent):
+            try:
+                os.makedirs(parent)
+            except OSError:
+                if not os.path.isdir(parent):
+                    raise
+        return path
+
+    def version_path(self, slug, timestamp):
+        return self._path("versions", self._name(slug), "%s.json" % self._name(timestamp))
+
+    def lookup(self, slug, timestamp):
+        """
+        :return: (model directory, metadata) of a version already in the store, or None
+        """
+        try:
+            with open(self.version_path(slug, timestamp)) as version_file:
+                version = json.load(version_file)
+        except (IOError, ValueError):
+            return None
+        model_dir = self._path("models", version["sha256"])
+        if not os.path.isdir(model_dir):
+            return None
+        return model_dir, version["metadata"]
+
+    def retrieve(self, slug, timestamp, download, fetch_metadata):
+        """
+        Model directory and metadata of a version, downloading it first unless it is already in the store
+        :param download: download(offset) requests the archive from byte offset onwards and returns (offset the
+         response actually starts at, iterator of chunks).  The offset is 0 when the server ignored the range.
+        :param fetch_metadata: returns the metadata of the version
+        :return: (model directory, metadata)
+        """
+        stored = self.lookup(slug, timestamp)
+        if stored is not None:
+            self.log.debug("model %s:%s found in %s" % (slug, timestamp, stored[0]))
+            return stored
+        download_path = self._path("downloads", "%s@%s" % (self._name(slug), self._name(timestamp)))
+        with open("%s.lock" % download_path, "a") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            try:
+                # another process may have finished the download while this one waited for the lock
+                stored = self.lookup(slug, timestamp)
+                if stored is not None:
+                    return stored
+                return self._download(slug, timestamp, "%s.part" % download_path, download, fetch_metadata)
+            finally:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def _download(self, slug, timestamp, part_path, download, fetch_metadata):
+        offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+        if offset:
+            self.log.info("resuming download of model %s:%s at byte %d" % (slug, timestamp, offset))
+        (started_at, chunks) = download(offset)
+        with open(part_path, "r+b" if offset else "wb") as part:
+            part.seek(started_at)
+            part.truncate()
+            for chunk in chunks:
+                part.write(chunk)
+        sha256 = self.digest(part_path)
+        blob_path = self._path("blobs", "%s.zip" % sha256)
+        os.rename(part_path, blob_path)
+        model_dir = self.extract(sha256, blob_path)
+        metadata = fetch_metadata()
+        self.write_atomically(self.version_path(slug, timestamp), json.dumps({"sha256": sha256,
+                                                                              "metadata": metadata}))
+        return model_dir, metadata
+
+    @staticmethod
+    def digest(path):
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as blob:
+            for chunk in iter(lambda: blob.read(CHUNK_SIZE), ""):
+                sha256.update(chunk)
+        return sha256.hexdigest()
+
+    def extract(self, sha256, blob_path):
+        model_dir = self._path("models", sha256)
+        if os.path.isdir(model_dir):
+            return model_dir
+        extracting = tempfile.mkdtemp(prefix=".%s." % sha256, dir=os.path.dirname(model_dir))
+        try:
+            with zipfile.ZipFile(blob_path) as archive:
+                archive.extractall(extracting)
+            self.make_read_only(extracting)
+            os.rename(extracting, model_dir)
+        except OSError:
+            # another process extracted the same archive first
+            if not os.path.isdir(model_dir):
+                raise
+        finally:
+            if os.path.isdir(extracting):
+                shutil.rmtree(extracting)
+        return model_dir
+
+    @staticmethod
+    def make_read_only(directory):
+        # a workspace writing to a linked file would change the model of every workspace
+        for (parent, _, names) in os.walk(directory):
+            for name in names:
+                path = os.path.join(parent, name)
+                os.chmod(path, os.stat(path).st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+
+    @staticmethod
+    def write_atomically(path, data):
+        (fd, temp_path) = tempfile.mkstemp(prefix=".", dir=os.path.dirname(path))
+        with os.fdopen(fd, "w") as out:
+            out.write(data)
+        os.rename(temp_path, path)
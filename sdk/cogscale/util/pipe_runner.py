@@ -14,18 +14,25 @@
 # limitations under the License.
 #
 
+import copy
 import logging
 from threading import Thread, Event, Lock
+from Queue import Queue, Full, Empty
 import sys
 import signal
-import json
+import time
 import traceback
 
-from jsonpickle import encode
-
 from cogscale.agents.environment import AgentEnvironment
 from cogscale.types.records import UnitOfWork
 from cogscale.types.models import Model
+from cogscale.util.framing import JsonLineFraming, available_formats, framing_for
+from cogscale.util.batching import DataBatcher, MicroBatcher
+from cogscale.util import tracing
+from cogscale.util.metrics import Metrics, timed_iter, SAMPLE_EVERY
+from cogscale.util.model_cache import ModelCache
+from cogscale.util.prediction_cache import PredictionCache, MISSING, stable_hash
+from cogscale.util.workers import WorkerPool, WorkerTimeout, THREAD_WORKERS, PROCESS_WORKERS
 
 
 class SourcingStatus(object):
@@ -37,6 +44,12 @@ class SourcingStatus(object):
         self.excludedCount = 0
         self.errorText = None
         self.details = None
+        self.pipe = None
+        self.token = None
+        self.metrics = None
+        self.modelCache = None
+        self.predictionCache = None
+        self.microBatching = None
 
 
 '''
@@ -58,6 +71,8 @@ stopping: * exit DataResponse Loop
 stopping: * set running = False
 StopRequest --> stopping
 stopping --> StopResponse : shutdownComplete = True
+WarmupRequest --> warming : load models, set agent up
+warming --> WarmResponse : currentState = warm
 }
 @enduml
 '''
@@ -65,27 +80,190 @@ stopping --> StopResponse : shutdownComplete = True
 SHUTDOWN_TIMEOUT_SECONDS = 25.0
 SIGINT_SHUTDOWN_TIMEOUT_SECONDS = 5.0
 FATAL_ERROR_CODE = "FATAL"
+DEFAULT_STREAM_CHUNK_SIZE = 100
+DEFAULT_PREDICTION_BATCH_SIZE = 100
+DEFAULT_ENRICHMENT_WORKERS = 4
+DEFAULT_PUBLISH_BULK_SIZE = 100
+WRITER_BATCH_SIZE = 256
+_WRITER_STOP = object()
 
 
 class MessagePipe(object):
-    def __init__(self, input=sys.stdin, output=sys.stdout):
+    def __init__(self, input=sys.stdin, output=sys.stdout, writer_queue_size=None):
+        """
+        :param input: file the host writes requests to
+        :param output: file responses are written to
+        :param writer_queue_size: when set, send encodes messages and a dedicated writer thread writes them, fed by a
+         queue bounded to this many messages.  send only blocks once the queue is full.  When a write fails the
+         writer drops everything queued after it and the next send or close raises the error.
+        """
         self.log = logging.getLogger()
         self.output = output
         self.input = input
         self.sending_lock = Lock()
+        self.framing = JsonLineFraming()
+        self.metrics = Metrics()
+        self.encode_timing = self.metrics.timing("encode")
+        self.payload_timing = self.metrics.timing("encodePayload")
+        self.payloads = 0
+        self.messages = 0
+        self.writes = 0
+        self.bytes_sent = 0
+        self.write_timing = self.metrics.timing("write")
+        self.writer = None
+        # exc_info of the write that failed on the writer thread
+        self.write_error = None
+        if writer_queue_size:
+            self.queue = Queue(maxsize=writer_queue_size)
+            self.max_queue_depth = 0
+            self.blocked_sends = 0
+            self.blocked_seconds = 0.0
+            self.dropped_messages = 0
+            self.writer = Thread(target=self._drain_queue, name="pipe_writer")
+            self.writer.daemon = True
+            self.writer.start()
+
+    def supported_formats(self):
+        return available_formats()
+
+    def use_format(self, name, acknowledgement=None):
+        """
+        Switch both directions of the pipe to another framing
+        :param name: name of a format returned by supported_formats
+        :param acknowledgement: optional message sent with the current framing just before switching
+        """
+        framing = framing_for(name)
+        with self.sending_lock:
+            if acknowledgement is not None:
+                self._send(acknowledgement)
+            self.framing = framing
+        self.log.info("pipe switched to %s framing" % name)
 
     def send(self, obj):
-        with self.sending_lock:
-            msg = encode(obj, unpicklable=False)
-            self.log.debug("sending %s" % msg)
-            print >> self.output, msg
+        with tracing.span("pipe.send", "pipe"):
+            with self.sending_lock:
+                self._send(obj)
+
+    def encode_payload(self, obj):
+        """
+        Encode one element of a batched message body ahead of sending it with send_batch
+        """
+        # called once per record, so only a sample is timed
+        self.payloads += 1
+        if self.payloads % SAMPLE_EVERY:
+            return self.framing.encode_fragment(obj)
+        started = time.time()
+        fragment = self.framing.encode_fragment(obj)
+        self.payload_timing.record(time.time() - started)
+        return fragment
+
+    def send_batch(self, response, fragments):
+        """
+        Send a single {response:, payload: {body: [...]}} message built from pre-encoded payloads
+        :param response: response type (i.e. DATA)
+        :param fragments: list of payloads encoded by encode_payload
+        """
+        with tracing.span("pipe.send_batch", "pipe", {"payloads": len(fragments)}), self.sending_lock:
+            self._send_encoded(self._encode(self.framing.encode_batch, (response, fragments)))
+
+    def close(self):
+        """
+        Wait for the writer thread to write everything queued so far, then stop it.  Raises the error of a write
+        that failed on the writer thread.
+        """
+        if self.writer is not None:
+            self.queue.put(_WRITER_STOP)
+            self.writer.join()
+            self.writer = None
+        self._raise_write_error()
+
+    def stats(self):
+        """
+        :return: sampled encode and write timings, payload, message, write and byte counters, plus the queue state
+         when a writer thread is used
+        """
+        stats = self.metrics.snapshot(payloads=self.payloads, messages=self.messages, writes=self.writes,
+                                      bytesSent=self.bytes_sent)
+        if self.writer is not None:
+            stats.update({"queueDepth": self.queue.qsize(), "maxQueueDepth": self.max_queue_depth,
+                          "blockedSends": self.blocked_sends, "blockedSeconds": self.blocked_seconds,
+                          "droppedMessages": self.dropped_messages})
+        return stats
+
+    def _raise_write_error(self):
+        if self.write_error is not None:
+            (error_type, error, tb) = self.write_error
+            raise error_type, error, tb
+
+    def _enqueue(self, msg):
+        self._raise_write_error()
+        try:
+            self.queue.put_nowait(msg)
+        except Full:
+            started = time.time()
+            self.queue.put(msg)
+            self.blocked_sends += 1
+            self.blocked_seconds += time.time() - started
+
+    def _drain_queue(self):
+        while True:
+            items = [self.queue.get()]
+            try:
+                while len(items) < WRITER_BATCH_SIZE:
+                    items.append(self.queue.get_nowait())
+            except Empty:
+                pass
+            self.max_queue_depth = max(self.max_queue_depth, len(items) + self.queue.qsize())
+            stopping = _WRITER_STOP in items
+            chunks = items[:items.index(_WRITER_STOP)] if stopping else items
+            if chunks and self.write_error is not None:
+                # keep draining so senders never block on a pipe nobody writes to
+                self.dropped_messages += len(chunks)
+            elif chunks:
+                try:
+                    self._write_encoded("".join(chunks))
+                except Exception:
+                    self.write_error = sys.exc_info()
+                    self.dropped_messages += len(chunks)
+                    self.log.error("Unable to write to the pipe, dropping messages", exc_info=True)
+            if stopping:
+                return
+
+    def _send(self, obj):
+        self._send_encoded(self._encode(self.framing.encode, (obj,)))
+
+    def _send_encoded(self, msg):
+        if self.writer is not None:
+            self._enqueue(msg)
+        else:
+            self._write_encoded(msg)
+
+    def _encode(self, encode, args):
+        self.messages += 1
+        if self.messages % SAMPLE_EVERY:
+            return encode(*args)
+        started = time.time()
+        msg = encode(*args)
+        self.encode_timing.record(time.time() - started)
+        return msg
+
+    def _write_encoded(self, msg):
+        if self.log.isEnabledFor(logging.DEBUG):
+            self.log.debug("sending %r" % msg)
+        self.writes += 1
+        self.bytes_sent += len(msg)
+        started = time.time()
+        with tracing.span("pipe.write", "pipe", {"bytes": len(msg)}):
+            self.output.write(msg)
             self.output.flush()
+        if self.writes % SAMPLE_EVERY == 0:
+            self.write_timing.record(time.time() - started)
 
     def receive(self):
-        userinput = self.input.readline()
-        userinput = userinput.rstrip('\n')
-        self.log.debug("received %s" % userinput)
-        return json.loads(userinput)
+        with tracing.span("pipe.receive", "pipe"):
+            request = self.framing.read(self.input)
+        self.log.debug("received %s" % request)
+        return request
 
 
 class BaseProcess(object):
@@ -95,20 +273,49 @@ class BaseProcess(object):
         self.shutdown_requested.clear()
         self.shutdown_ready = Event()
         self.shutdown_ready.clear()
+        self.cancelled = Event()
         self.status = status
         self.status_lock = Lock()
-        self.model_cache = dict()
+        self.model_cache = ModelCache()
+        # config key -> (config key, slug, timestamp) of the model the last START used
+        self.model_versions = dict()
+        self.start_metrics()
+        # shared with every job of this process, keyed by (size, mode)
+        self.pools = dict()
+        self.pools_lock = Lock()
+        # process pools forked with an older context, joined on shutdown
+        self.retired_pools = []
+        # config key -> ((config key, slug, timestamp), Model) loaded by the last warmup
+        self.warm_models = dict()
 
     def request_shutdown(self):
         self.shutdown_requested.set()
 
+    def cancel(self):
+        """
+        Stop this job as soon as possible, unlike a shutdown a prediction in progress is abandoned as well
+        """
+        self.cancelled.set()
+        self.request_shutdown()
+
     def shutdown_in_progress(self):
         return self.shutdown_requested.is_set() and not self.shutdown_ready.is_set()
 
     def is_shutdown_ready(self, timeout):
         return self.shutdown_ready.wait(timeout)
 
+    def start_metrics(self):
+        """
+        New metrics for a run, its counters and rates only count the records of this run
+        """
+        self.metrics = Metrics()
+        self.counts_at_start = (self.status.successCount, self.status.excludedCount)
+
     def get_status(self):
+        (success_at_start, excluded_at_start) = self.counts_at_start
+        self.status.metrics = self.metrics.snapshot(records=self.status.successCount - success_at_start,
+                                                    excluded=self.status.excludedCount - excluded_at_start)
+        self.status.modelCache = self.model_cache.stats()
         return self.status
 
     def run(self, *args, **kwargs):
@@ -117,6 +324,139 @@ class BaseProcess(object):
     def shutdown(self):
         pass
 
+    def new_job(self, token):
+        """
+        A process for another concurrent job of the same agent.  The job has its own status and shutdown events but
+        shares the environment, model cache and worker pools with this process.
+        """
+        job = copy.copy(self)
+        job.status = SourcingStatus()
+        job.status.token = token
+        job.status_lock = Lock()
+        job.shutdown_requested = Event()
+        job.shutdown_ready = Event()
+        job.cancelled = Event()
+        job.start_metrics()
+        return job
+
+    def setup_agent(self):
+        """
+        Set up the agent unless the shared environment already is, recording how long it took
+        """
+        started = time.time()
+        if self.environment.setup_once():
+            self.metrics.record("setup", time.time() - started)
+
+    def acquire_agent(self, config):
+        """
+        Set up the agent for a run that ends with release_agent, recording how long it took.  Concurrent jobs share
+        the set up agent and one with a config other than theirs is rejected, see AgentEnvironment.acquire.
+        """
+        started = time.time()
+        if self.environment.acquire(config):
+            self.metrics.record("setup", time.time() - started)
+
+    def release_agent(self):
+        self.environment.release()
+
+    def warmup(self, payload):
+        """
+        Get ready for a START ahead of time by loading the models it will use into the model cache and setting the
+        agent up
+        :param payload: START payload without data, i.e. {config:, <model key>: model blob}
+        """
+        self.status.currentState = "warming"
+        payload = dict(payload)
+        config = self.normalize_config(payload.pop("config", dict()))
+        payload = self.transform_models(config, payload)
+        self.warm_models = {k: ((k,) + self.model_version(config[k]), v) for (k, v) in payload.iteritems()
+                            if isinstance(v, Model)}
+        if self.environment is not None:
+            self.environment.context.update(config)
+            self.environment.context.update({k: model for (k, (_, model)) in self.warm_models.iteritems()})
+            self.environment.setup_once(config)
+        self.status.currentState = "warm"
+
+    def use_models(self, config, kwargs):
+        """
+        Load the model blobs of a START through the model cache and put the models in the agent context.  A model key
+        without a blob gets the model the last warmup loaded for it, as long as the START names the same version.
+        :param config: config of the START
+        :param kwargs: START payload
+        :return: kwargs with the model blobs replaced by their models
+        """
+        kwargs = self.transform_models(config, kwargs)
+        models = dict()
+        for key in self.keys_with_value_type(config, "model"):
+            if isinstance(kwargs.get(key), Model):
+                models[key] = kwargs[key]
+            elif key in self.warm_models and self.warm_models[key][0] == (key,) + self.model_version(config[key]):
+                models[key] = self.warm_models[key][1]
+        if models and self.environment is not None:
+            self.environment.context.update(models)
+        return kwargs
+
+    def share_models(self):
+        """
+        Move the models in the agent context into shared memory so forked workers use the parent's copy.  This is
+        best effort, a model that cannot be moved is shared copy-on-write instead.
+        """
+        for (key, value) in self.environment.context.items():
+            if isinstance(value, MicroBatcher):
+                value = value.model
+            if isinstance(value, Model) and not getattr(value, "shared", False):
+                self.log.info("moving model %s to shared memory" % key)
+                try:
+                    value.share_memory()
+                except Exception:
+                    self.log.warn("Unable to move model %s to shared memory, workers share it copy-on-write" % key,
+                                  exc_info=True)
+
+    @staticmethod
+    def same_context(forked, context):
+        """
+        :param forked: copy of the context taken when workers were forked
+        :return: True if no value of context changed since
+        """
+        if forked.viewkeys() != context.viewkeys():
+            return False
+        for (key, value) in context.iteritems():
+            if value is forked[key]:
+                continue
+            try:
+                if not bool(value == forked[key]):
+                    return False
+            except Exception:
+                # i.e. arrays, which do not compare to a single bool
+                return False
+        return True
+
+    def worker_pool(self, size, mode=THREAD_WORKERS):
+        # process workers fork with the set up environment, so pools live until the process shuts down or a START
+        # changes the context they forked with (i.e. a new config or model version)
+        with self.pools_lock:
+            pool = self.pools.get((size, mode))
+            forked = pool.forked_context if pool is not None and mode == PROCESS_WORKERS else None
+            if forked is not None and not self.same_context(forked, self.environment.context):
+                self.log.info("agent context changed, replacing %d process workers" % size)
+                pool.retire()
+                self.retired_pools.append(pool)
+                pool = None
+            if pool is None:
+                if mode == PROCESS_WORKERS:
+                    self.share_models()
+                pool = WorkerPool(size, mode, context=self.environment)
+                pool.forked_context = dict(self.environment.context)
+                self.pools[(size, mode)] = pool
+            return pool
+
+    def close_workers(self):
+        with self.pools_lock:
+            for pool in self.pools.values() + self.retired_pools:
+                pool.close()
+            self.pools.clear()
+            del self.retired_pools[:]
+
     def should_send_status(self):
         return True
 
@@ -128,6 +468,25 @@ class BaseProcess(object):
         with self.status_lock:
             self.status.excludedCount += 1
 
+    def exclude_unsent(self, count):
+        """
+        Count records already counted as successes as excluded, their batch could not be sent
+        """
+        with self.status_lock:
+            self.status.successCount -= count
+            self.status.excludedCount += count
+
+    def close_batcher(self, batcher):
+        """
+        Send what is left in batcher when a run ends, failures are only logged as the run is over either way
+        """
+        if batcher is None:
+            return
+        try:
+            batcher.close()
+        except Exception:
+            self.log.error("Unable to send the last batch of DATA", exc_info=True)
+
     def fatal_status(self, msg):
         self.log.error(msg, exc_info=True)
         self.status.errorCode = FATAL_ERROR_CODE
@@ -179,10 +538,29 @@ class BaseProcess(object):
 
         return {k: transform_value(v) for (k, v) in config.iteritems()}
 
-    def get_or_update_model(self, name, pickle):
-        if name not in self.model_cache:
-            self.model_cache[name] = Model.deserialize(pickle)
-        return self.model_cache.get(name)
+    @staticmethod
+    def model_version(value):
+        """
+        :param value: model config value, {type: "model", model: slug, timestamp:} or "model:slug/timestamp"
+        :return: (slug, timestamp)
+        """
+        if isinstance(value, dict):
+            return (value.get("model"), value.get("timestamp"))
+        (slug, _, timestamp) = str(value)[6:].strip().partition("/")
+        return (slug, timestamp or None)
+
+    def get_or_update_model(self, name, version, pickle):
+        previous = self.model_versions.get(name)
+        if previous is not None and previous != version:
+            self.log.info("model %s changed from %s to %s" % (name, previous, version))
+            self.model_cache.invalidate(previous)
+        self.model_versions[name] = version
+
+        def load():
+            model = Model.deserialize(pickle)
+            return (model, len(pickle))
+
+        return self.model_cache.get(version, load)
 
     def transform_models(self, config, payload):
         """
@@ -195,47 +573,252 @@ class BaseProcess(object):
 
         def transform(k, value):
             if k in model_keys and not isinstance(value, Model):
-                return self.get_or_update_model(k, value)
+                return self.get_or_update_model(k, (k,) + self.model_version(config[k]), value)
             else:
                 return value
 
         return {k: transform(k, v) for (k, v) in payload.iteritems()}
 
 
+# worker results end with the seconds spent in the agent so the timing survives process workers
+
+
+def _run_prediction(environment, item):
+    (index, value) = item
+    started = time.time()
+    try:
+        return index, True, environment.run(value), time.time() - started
+    except Exception:
+        return index, False, traceback.format_exc(), time.time() - started
+
+
+def _run_batch_agent(environment, values):
+    predictions = list(environment.run(values))
+    if len(predictions) != len(values):
+        raise ValueError("batch agent returned %d predictions for %d values" % (len(predictions), len(values)))
+    return predictions
+
+
+def _run_prediction_batch(environment, item):
+    (start, values) = item
+    started = time.time()
+    try:
+        predictions = _run_batch_agent(environment, values)
+        # the batch is a single agent call, so only its first result carries the elapsed time
+        elapsed = [time.time() - started] + [None] * (len(predictions) - 1)
+        return [(start + offset, True, prediction, elapsed[offset]) for (offset, prediction) in enumerate(predictions)]
+    except Exception:
+        # fall back to one value per call so a bad value is skipped on its own
+        results = []
+        for (offset, value) in enumerate(values):
+            started = time.time()
+            try:
+                (prediction,) = _run_batch_agent(environment, [value])
+                results.append((start + offset, True, prediction, time.time() - started))
+            except Exception:
+                results.append((start + offset, False, traceback.format_exc(), time.time() - started))
+        return results
+
+
+def _run_enrichment(environment, item):
+    (uow, kwargs) = item
+    started = time.time()
+    try:
+        # drain the agent's generator on the worker so the consumer only sends records
+        return uow, True, list(environment.run(**kwargs)), time.time() - started
+    except Exception:
+        return uow, False, traceback.format_exc(), time.time() - started
+
+
+def _flatten_batches(batches):
+    try:
+        for batch in batches:
+            for result in batch:
+                yield result
+    finally:
+        batches.close()
+
+
 class PredictionProcess(BaseProcess):
-    def __init__(self, environment):
+    def __init__(self, environment, workers=1, worker_mode=THREAD_WORKERS, cache_size=None, cache_ttl=None,
+                 micro_batch=False):
+        """
+        :param environment: environment of the @predict agent
+        :param workers: default number of predictions run concurrently, a START payload may override it with
+         {"workers": {"size":, "mode":, "microBatch":}}
+        :param worker_mode: "thread" for I/O bound agents or "process" for CPU bound agents
+        :param cache_size: keep this many predictions to answer repeated values from, None to always call the agent
+        :param cache_ttl: seconds a cached prediction is served for
+        :param micro_batch: in runs on several thread workers, batch the concurrent predict_single calls the agent
+         makes on the models in its context into Model.predict_batch calls
+        """
         super(PredictionProcess, self).__init__()
         self.environment = environment
-        self.is_setup = False
+        self.workers = workers
+        self.worker_mode = worker_mode
+        self.prediction_cache = PredictionCache(cache_size, ttl=cache_ttl) if cache_size else None
+        self.micro_batch = micro_batch
+        # context key -> MicroBatcher standing in for the model
+        self.micro_batchers = dict()
+        self.micro_batchers_lock = Lock()
+
+    def get_status(self):
+        status = super(PredictionProcess, self).get_status()
+        if self.prediction_cache is not None:
+            status.predictionCache = self.prediction_cache.stats()
+        if self.micro_batchers:
+            status.microBatching = {key: batcher.stats() for (key, batcher) in self.micro_batchers.items()}
+        return status
+
+    def micro_batch_models(self, enabled):
+        """
+        Put a MicroBatcher in the agent context in place of every model, or put the models back
+        """
+        context = self.environment.context
+        with self.micro_batchers_lock:
+            for (key, value) in context.items():
+                batcher = self.micro_batchers.get(key)
+                if batcher is not None and value is not batcher and value is not batcher.model:
+                    # a START replaced the model
+                    batcher.close()
+                    del self.micro_batchers[key]
+                    batcher = None
+                if batcher is None and enabled and isinstance(value, Model):
+                    batcher = self.micro_batchers[key] = MicroBatcher(value)
+                if batcher is not None:
+                    context[key] = batcher if enabled else batcher.model
+
+    def close_micro_batchers(self):
+        with self.micro_batchers_lock:
+            for batcher in self.micro_batchers.itervalues():
+                batcher.close()
+
+    def batch_size(self, requested):
+        """
+        Number of values handed to a batch capable agent (@predict(batch=True)) per call, None for per value agents
+        """
+        options = self.environment.agent_options
+        if not options.get("batch"):
+            return None
+        return int(requested or options.get("batch_size", DEFAULT_PREDICTION_BATCH_SIZE))
+
+    def predict(self, values, workers, batch_size=None):
+        """
+        Run the agent over values
+        :param values: list of values from the command body
+        :param workers: {size:, mode:} worker settings from the START payload
+        :param batch_size: hand the agent slices of this many values instead of one value per call
+        :return: generator of (index, success, prediction or traceback, agent seconds or None) in the order of values
+        """
+        size = int(workers.get("size", self.workers))
+        if batch_size:
+            func = _run_prediction_batch
+            items = ((start, values[start:start + batch_size]) for start in xrange(0, len(values), batch_size))
+        else:
+            func = _run_prediction
+            items = enumerate(values)
+        if size <= 1:
+            results = (func(self.environment, item) for item in items)
+        else:
+            results = self.worker_pool(size, workers.get("mode", self.worker_mode)).imap(func, items)
+        return _flatten_batches(results) if batch_size else results
+
+    def predict_cached(self, values, workers, batch_size, config):
+        """
+        predict for the values missing from the prediction cache, in the order of values.  Cached predictions are
+        keyed by the agent, its config (which names the model version) and the value.  They are only looked up, and
+        counted as hits, as the caller reaches them.
+        """
+        cache = self.prediction_cache
+        version = stable_hash({"agent": self.environment.name, "config": config})
+        keys = [cache.key(version, value) for value in values]
+        missing = [index for (index, key) in enumerate(keys) if not cache.contains(key)]
+        results = self.predict([values[index] for index in missing], workers, batch_size)
+        missing = set(missing)
+        try:
+            for (index, key) in enumerate(keys):
+                predicted = next(results) if index in missing else None
+                prediction = cache.get(key)
+                if prediction is not MISSING:
+                    # predicted values repeated in the body are answered like their first occurrence
+                    yield (index, True, prediction, predicted[3] if predicted is not None else None)
+                    continue
+                if predicted is None:
+                    # evicted or expired since it was looked up
+                    predicted = next(self.predict([values[index]], {"size": 1}, batch_size))
+                (_, success, result, elapsed) = predicted
+                if success:
+                    cache.put(key, result)
+                yield (index, success, result, elapsed)
+        finally:
+            results.close()
+
+    @staticmethod
+    def stream_chunk_size(stream):
+        """
+        Chunk size for the "stream" setting of a START payload: true or {chunkSize:} to stream, absent to send one
+        DATA message once every prediction is done
+        """
+        if not stream:
+            return None
+        if isinstance(stream, dict):
+            return int(stream.get("chunkSize", DEFAULT_STREAM_CHUNK_SIZE))
+        return DEFAULT_STREAM_CHUNK_SIZE
 
     def run(self, pipe, **kwargs):
+        token = None
+        chunk_size = None
+        counter = 1
+        self.start_metrics()
+        agent_timing = self.metrics.timing("agent")
         try:
             self.status.completed = False
             self.shutdown_ready.clear()
             config = kwargs.pop("config")
             limit = kwargs.get("limit")
+            workers = kwargs.get("workers") or dict()
+            chunk_size = self.stream_chunk_size(kwargs.get("stream"))
             command = kwargs.pop("command", dict())
             token = command.get("token", dict())
             source_data = command.pop("body")
             self.environment.context.update(config)
+            self.use_models(config, kwargs)
             self.log.info("launching prediction with %d records" % len(source_data))
-            if self.environment is not None and not self.is_setup:
-                self.environment.setup()
-                self.is_setup = True
+            if self.environment is not None:
+                self.setup_agent()
+            self.micro_batch_models(workers.get("microBatch", self.micro_batch)
+                                    and workers.get("mode", self.worker_mode) == THREAD_WORKERS
+                                    and int(workers.get("size", self.workers)) > 1)
             self.status.running = True
             early_exit = False
-            counter = 1
             predictions = []
-            for (index, value) in enumerate(source_data):
+            if self.prediction_cache is not None:
+                results = self.predict_cached(source_data, workers, self.batch_size(kwargs.get("batchSize")), config)
+            else:
+                results = self.predict(source_data, workers, self.batch_size(kwargs.get("batchSize")))
+            for (index, success, result, elapsed) in results:
+                if elapsed is not None:
+                    agent_timing.record(elapsed)
+                if self.cancelled.isSet():
+                    early_exit = True
+                    break
                 if limit is not None and counter > limit:
                     break
-                try:
-                    prediction = self.environment.run(value)
-                    predictions.append(prediction)
+                if success:
+                    predictions.append(result)
                     counter += 1
-                except Exception, e:
+                    self.inc_success_count()
+                    if chunk_size and len(predictions) >= chunk_size:
+                        pipe.send({"response": "DATA", "payload": {"token": token, "body": predictions}})
+                        predictions = []
+                    if limit is not None and counter > limit:
+                        # without asking for the next result, a cached one would be looked up for nothing
+                        break
+                else:
+                    value = source_data[index]
                     self.log.warn("Unable to process prediction %s" % value)
-                    pipe.send({"response": "SKIPPED", "payload": {"reason": "error", "details": traceback.format_exc(), "token": token, "job_value": value, "index": index}})
+                    pipe.send({"response": "SKIPPED", "payload": {"reason": "error", "details": result, "token": token, "job_value": value, "index": index}})
+            results.close()
             if len(predictions) > 0:
                 pipe.send({"response": "DATA", "payload": {"token": token, "body": predictions}})
         except Exception, e:
@@ -245,9 +828,17 @@ class PredictionProcess(BaseProcess):
         if not early_exit:
             self.status.completed = True
 
+        if chunk_size:
+            # streamed DATA may arrive in any number of chunks, this marks the last one for the token
+            pipe.send({"response": "DONE", "payload": {"token": token, "count": counter - 1,
+                                                       "completed": self.status.completed}})
+
+        self.metrics.finish()
         self.shutdown_ready.set()
 
     def shutdown(self):
+        self.close_workers()
+        self.close_micro_batchers()
         if self.environment is not None:
             self.environment.teardown()
         super(PredictionProcess, self).shutdown()
@@ -258,30 +849,78 @@ class EnrichmentProcess(BaseProcess):
         super(EnrichmentProcess, self).__init__()
         self.environment = environment
         self.record_id_key = "_keys"
-        self.is_setup = False
 
     def to_key(self, keys):
         return {self.record_id_key: keys}
 
-    def process_records(self, pipe, records, counter, limit):
+    def process_records(self, batcher, records, counter, limit):
+        """
+        :return: (early_exit, counter) with counter carried over to the next unit of work
+        """
         for record in records:
             counter += 1
             if self.shutdown_requested.isSet():
-                return True
+                return True, counter
+            batcher.add(record.to_ardrecord())
             self.inc_success_count()
-            payload = record.to_ardrecord()
-            pipe.send({"response": "DATA", "payload": payload})
             if limit and counter >= limit:
                 self.request_shutdown()
-        return False
+        return False, counter
+
+    def process_concurrently(self, batcher, uow_s, data_key, kwargs, limit, concurrency):
+        """
+        Run the agent over several units of work at once on a thread pool, the agent and its context must be
+        thread safe
+        :param concurrency: {workers:, ordered:, timeout:} from the START payload.  Records are sent in unit of work
+         order unless ordered is false.  A unit of work running longer than timeout seconds is counted as excluded
+         and abandoned: it keeps running on its worker but its records are dropped.
+        :return: True if the run stopped early
+        """
+
+        def tasks():
+            for uow in uow_s:
+                # stop handing out work as soon as a shutdown or the limit is hit
+                if self.shutdown_requested.isSet():
+                    return
+                task_kwargs = dict(kwargs)
+                task_kwargs[data_key] = uow
+                yield uow, task_kwargs
+
+        pool = self.worker_pool(int(concurrency.get("workers", DEFAULT_ENRICHMENT_WORKERS)))
+        run = pool.imap if concurrency.get("ordered", True) else pool.imap_unordered
+        results = run(_run_enrichment, tasks(), concurrency.get("timeout"))
+        counter = 0
+        finished = 0
+        try:
+            for result in results:
+                finished += 1
+                if isinstance(result, WorkerTimeout):
+                    (uow, _) = result.item
+                    self.log.warn("Unit of work %s timed out after %s seconds" % (uow.key, result.timeout))
+                    self.inc_excluded_count()
+                    continue
+                (uow, success, records, elapsed) = result
+                self.metrics.record("unitOfWork", elapsed)
+                if not success:
+                    raise Exception("Unable to enrich unit of work %s\n%s" % (uow.key, records))
+                (early_exit, counter) = self.process_records(batcher, records, counter, limit)
+                if early_exit:
+                    return True
+        finally:
+            results.close()
+        return finished < len(uow_s)
 
     def run(self, pipe, **kwargs):
+        self.start_metrics()
+        batcher = None
         try:
             self.status.completed = False
             self.shutdown_ready.clear()
             # TODO - implement model as a service client [PLAT-560]
             config = self.normalize_config(kwargs.pop("config", dict()))
             limit = kwargs.pop("limit", None)
+            batcher = DataBatcher.from_config(pipe, kwargs.pop("batch", None), failed=self.exclude_unsent)
+            concurrency = kwargs.pop("concurrency", None)
             data_key = self.keys_with_value_type(config, "query")[0]
             if len(self.keys_with_value_type(config, "model")) > 0:
                 raise Exception("Models are not currently supported in enrichments")
@@ -293,27 +932,34 @@ class EnrichmentProcess(BaseProcess):
             source_data = kwargs.pop(data_key)
             uow_s = [UnitOfWork(self.to_key(obj['key']), obj['value']) for obj in source_data]
             self.environment.context.update(config)
-            if not self.is_setup:
-                self.environment.setup()
-                self.is_setup = True
-            counter = 0
-            for uow in uow_s:
-                if self.shutdown_requested.isSet():
-                    early_exit = True
-                    break
-                kwargs[data_key] = uow
-                records = self.environment.run(**kwargs)
-                early_exit = self.process_records(pipe, records, counter, limit)
+            self.setup_agent()
+            if concurrency:
+                early_exit = self.process_concurrently(batcher, uow_s, data_key, kwargs, limit, concurrency)
+            else:
+                counter = 0
+                agent_timing = self.metrics.timing("agent")
+                for uow in uow_s:
+                    if self.shutdown_requested.isSet():
+                        early_exit = True
+                        break
+                    kwargs[data_key] = uow
+                    records = timed_iter(self.environment.run(**kwargs), agent_timing)
+                    (early_exit, counter) = self.process_records(batcher, records, counter, limit)
+            batcher.close()
         except Exception, e:
             self.fatal_status("Unable to enrich")
             early_exit = True
+        finally:
+            self.close_batcher(batcher)
 
         if not early_exit:
             self.status.completed = True
 
+        self.metrics.finish()
         self.shutdown_ready.set()
 
     def shutdown(self):
+        self.close_workers()
         self.environment.teardown()
         super(EnrichmentProcess, self).shutdown()
 
@@ -326,25 +972,32 @@ class LearningProcess(BaseProcess):
         self.status_lock = Lock()
 
     def run(self, pipe, **kwargs):
+        self.start_metrics()
         self.status.running = True
         self.shutdown_ready.clear()
         early_exit = False
+        acquired = False
         try:
             config = self.normalize_config(kwargs.pop("config", dict()))
             self.log.info("launching learning agent with %s" % config)
-            self.environment.context.update(config)
-            self.environment.setup()
+            self.acquire_agent(config)
+            acquired = True
+            kwargs = self.use_models(config, kwargs)
+            started = time.time()
             model_metadata = self.environment.run(**kwargs)
+            self.metrics.record("agent", time.time() - started)
             pipe.send({"response": "DATA", "payload": {"metadata": model_metadata}})
         except Exception, e:
             self.fatal_status("Unable to call training")
             early_exit = True
         finally:
-            self.environment.teardown()
+            if acquired:
+                self.release_agent()
 
         if not early_exit:
             self.status.completed = True
 
+        self.metrics.finish()
         self.shutdown_ready.set()
 
 
@@ -354,26 +1007,28 @@ class SourcingProcess(BaseProcess):
         self.environment = environment
 
     def run(self, pipe, **kwargs):
+        self.start_metrics()
         self.status.running = True
         self.shutdown_ready.clear()
         config = self.normalize_config(kwargs.pop("config", dict()))
         limit = kwargs.pop("limit", None)
+        batcher = DataBatcher.from_config(pipe, kwargs.pop("batch", None), failed=self.exclude_unsent)
 
         self.log.info("launching sourcing agent with %s" % config)
-        if config:
-            self.environment.context.update(config)
-
-        self.environment.setup()
         early_exit = False
-        records = self.environment.run()
+        acquired = False
         counter = 0
         try:
+            self.acquire_agent(config)
+            acquired = True
+            self.use_models(config, kwargs)
+            records = timed_iter(self.environment.run(), self.metrics.timing("agent"))
             for r in records:
                 if self.shutdown_requested.isSet():
                     early_exit = True
                     break
                 try:
-                    pipe.send({"response": "DATA", "payload": r.to_ardrecord()})
+                    batcher.add(r.to_ardrecord())
                     self.inc_success_count()
                 except:
                     # eventually pipe error records to separate stream for correction
@@ -381,12 +1036,17 @@ class SourcingProcess(BaseProcess):
                 counter += 1
                 if limit and counter >= limit:
                     break
+            batcher.close()
         except Exception, e:
             early_exit = True
             self.fatal_status("An exception occured while sourcing.")
-        self.environment.teardown()
+        finally:
+            self.close_batcher(batcher)
+            if acquired:
+                self.release_agent()
         if not early_exit:
             self.status.completed = True
+        self.metrics.finish()
         self.log.info("Sourced %d records" % self.status.successCount)
         self.shutdown_ready.set()
 
@@ -396,27 +1056,64 @@ class PublishProcess(BaseProcess):
         super(PublishProcess, self).__init__()
         self.environment = environment
         self.record_id_key = "_keys"
-        self.is_setup = False
 
     def to_key(self, keys):
         return {self.record_id_key: keys}
 
+    def bulk_size(self, requested):
+        """
+        Number of units of work handed to a bulk capable agent (@publish(bulk=True)) per call, None for per unit of
+        work agents
+        """
+        options = self.environment.agent_options
+        if not options.get("bulk"):
+            return None
+        return int(requested or options.get("bulk_size", DEFAULT_PUBLISH_BULK_SIZE))
+
     def process_status(self, pipe, status, counter, limit):
+        """
+        :return: (early_exit, counter) with counter carried over to the next call of the agent
+        """
         for st in status:
             counter += 1
             if self.shutdown_requested.isSet():
-                return True
+                return True, counter
             if st.success:
                 self.inc_success_count()
             if limit and counter >= limit:
                 self.request_shutdown()
-        return False
+        return False, counter
+
+    def process_bulk_status(self, pipe, uow_s, status, counter, limit):
+        """
+        Count the statuses of one bulk call and report the units of work that failed as a single SKIPPED message
+        :return: (early_exit, counter)
+        """
+        status = list(status)
+        if len(status) != len(uow_s):
+            raise ValueError("bulk agent returned %d statuses for %d units of work" % (len(status), len(uow_s)))
+        failed = [st.summarize() for st in status if not st.success]
+        for st in failed:
+            self.inc_excluded_count()
+        if failed:
+            self.log.warn("Unable to publish %d of %d units of work" % (len(failed), len(uow_s)))
+            pipe.send({"response": "SKIPPED", "payload": {"reason": "error", "failed": failed}})
+        return self.process_status(pipe, status, counter, limit)
+
+    def call_agent(self, timing, **kwargs):
+        started = time.time()
+        status = list(self.environment.run(**kwargs))
+        timing.record(time.time() - started)
+        return status
 
     def run(self, pipe, **kwargs):
+        self.start_metrics()
+        agent_timing = self.metrics.timing("agent")
         try:
             self.status.completed = False
             config = self.normalize_config(kwargs.pop("config", dict()))
             limit = kwargs.pop("limit", None)
+            bulk_size = self.bulk_size(kwargs.pop("bulkSize", None))
             data_key = self.keys_with_value_type(config, "query")[0]
             self.log.info("launching destination agent with %s" % config)
             self.status.running = True
@@ -424,18 +1121,30 @@ class PublishProcess(BaseProcess):
             source_data = kwargs.pop(data_key)
             uow_s = [UnitOfWork(self.to_key(obj['key']), obj['value']) for obj in source_data]
             self.environment.context.update(config)
-            if not self.is_setup:
-                self.environment.setup()
-                self.is_setup = True
+            kwargs = self.use_models(config, kwargs)
+            self.setup_agent()
             counter = 0
-            # for obj in source_data:
-            for uow in uow_s:
-                if self.shutdown_requested.isSet():
-                    early_exit = True
-                    break
-                kwargs[data_key] = uow
-                status = self.environment.run(**kwargs)
-                early_exit = self.process_status(pipe, status, counter, limit)
+            if bulk_size:
+                start = 0
+                while start < len(uow_s):
+                    if self.shutdown_requested.isSet():
+                        early_exit = True
+                        break
+                    # the last bulk before the limit only holds the units of work left to publish
+                    bulk = uow_s[start:start + (min(bulk_size, limit - counter) if limit else bulk_size)]
+                    start += len(bulk)
+                    kwargs[data_key] = bulk
+                    status = self.call_agent(agent_timing, **kwargs)
+                    (early_exit, counter) = self.process_bulk_status(pipe, bulk, status, counter, limit)
+            else:
+                # for obj in source_data:
+                for uow in uow_s:
+                    if self.shutdown_requested.isSet():
+                        early_exit = True
+                        break
+                    kwargs[data_key] = uow
+                    status = self.call_agent(agent_timing, **kwargs)
+                    (early_exit, counter) = self.process_status(pipe, status, counter, limit)
         except Exception, e:
             self.fatal_status("Unable to publish")
             early_exit = True
@@ -443,6 +1152,7 @@ class PublishProcess(BaseProcess):
         if not early_exit:
             self.status.completed = True
 
+        self.metrics.finish()
         if self.shutdown_in_progress():
             self.shutdown_ready.set()
 
@@ -452,11 +1162,12 @@ class PublishProcess(BaseProcess):
 
 
 class PipeRunner(object):
-    def __init__(self, pipe=MessagePipe(), process=None):
+    def __init__(self, pipe=MessagePipe(), process=None, warmup=None):
         """
         :param environment:
         :type environment: AgentEnvironment
         :param output:
+        :param warmup: payload of a WARMUP request to start on launch, before the host sends anything
         :return:
         """
         if process is None:
@@ -465,15 +1176,25 @@ class PipeRunner(object):
         self.pipe = pipe
         self.log = logging.getLogger()
         self.agent_thread = None
+        # jobs started with a token run concurrently on copies of the process, the process itself runs the job
+        # without a token
+        self.jobs = dict()
+        self.jobs_lock = Lock()
+        self.warmup_thread = None
 
         def handle_signal(signal, frame):
+            for job in self.running_jobs():
+                job.request_shutdown()
             self.process.request_shutdown()
             self.log.warn("received shutdown signal.")
             self.process.is_shutdown_ready(SIGINT_SHUTDOWN_TIMEOUT_SECONDS)
             self.log.info("exiting.")
 
         signal.signal(signal.SIGINT, handle_signal)
-        self.send({"response": "READY"})
+        # the host may answer with a FORMAT request to move the pipe off the default json line framing
+        self.send({"response": "READY", "payload": {"formats": self.pipe.supported_formats()}})
+        if warmup is not None:
+            self.warmup_command(warmup)
 
     def start(self):
         self.log.info("Started Polling")
@@ -490,36 +1211,155 @@ class PipeRunner(object):
         :return: boolean - True if ready to shutdown
         """
         requestType = request.get("request")
+        payload = request.get("payload", dict())
         if requestType == "STATUS":
-            status = self.process.get_status()
-            self.send_status(status)
+            self.status_command(payload.get("token"))
         elif (requestType == "START"):
-            self.start_command(request.get("payload", dict()))
+            self.start_command(payload)
+        elif requestType == "STOP" and payload.get("token") is not None:
+            self.stop_job_command(payload.get("token"), payload.get("timeout"))
         elif requestType == "STOP" and not self.process.shutdown_in_progress():
-            return self.stop_command(request.get("payload", dict()).get("timeout"))
+            return self.stop_command(payload.get("timeout"))
+        elif requestType == "FORMAT":
+            self.format_command(payload.get("format"))
+        elif requestType == "WARMUP":
+            self.warmup_command(payload)
         else:
             logging.warn("unexpected request")
         return False
 
+    @staticmethod
+    def job_token(payload):
+        # predictions already carry a token in their command
+        token = payload.get("token")
+        if token is None:
+            token = (payload.get("command") or dict()).get("token")
+        return token
+
+    def running_jobs(self):
+        with self.jobs_lock:
+            return self.jobs.values()
+
     def start_command(self, payload):
+        token = self.job_token(payload)
+        if token is None:
+            process = self.process
+        else:
+            with self.jobs_lock:
+                if token in self.jobs:
+                    process = None
+                else:
+                    process = self.jobs[token] = self.process.new_job(token)
+            if process is None:
+                self.log.warn("job %s is already running" % token)
+                self.send_status(self.job_error(token, "job %s is already running" % token))
+                return
+
+        warmup = self.warmup_thread
+
         def wrapper():
-            self.process.run(self.pipe, **payload)
-            if self.process.should_send_status():
-                status = self.process.get_status()
+            try:
+                if warmup is not None:
+                    warmup.join()
+                process.status.currentState = "running"
+                process.run(self.pipe, **payload)
+            finally:
+                # before the final status, so a START answering it can reuse the token
+                if token is not None:
+                    with self.jobs_lock:
+                        self.jobs.pop(token, None)
+            if process.should_send_status():
+                status = process.get_status()
                 self.send_status(status)
 
-        self.agent_thread = Thread(target=wrapper, name="agent_runner")
-        self.agent_thread.daemon = True
-        self.agent_thread.start()
+        thread = Thread(target=wrapper, name="agent_runner" if token is None else "agent_runner_%s" % token)
+        thread.daemon = True
+        if token is None:
+            self.agent_thread = thread
+        thread.start()
+
+    def warmup_command(self, payload):
+        """
+        Load models and set the agent up in the background, STATUS keeps being answered meanwhile.  A WARM response
+        is sent once the process is ready, a START sent before that waits for the warmup to finish.
+        """
+        previous = self.warmup_thread
+
+        def warm():
+            if previous is not None:
+                previous.join()
+            started = time.time()
+            response = {"currentState": "warm"}
+            try:
+                self.process.warmup(payload)
+            except Exception, e:
+                self.log.error("Unable to warm up", exc_info=True)
+                self.process.status.currentState = "cold"
+                response = {"currentState": "cold", "errorText": str(e), "details": traceback.format_exc()}
+            response["seconds"] = time.time() - started
+            response["modelCache"] = self.process.model_cache.stats()
+            self.send({"response": "WARM", "payload": response})
+
+        self.warmup_thread = Thread(target=warm, name="agent_warmup")
+        self.warmup_thread.daemon = True
+        self.warmup_thread.start()
+
+    def status_command(self, token=None):
+        if token is None:
+            self.send_status(self.process.get_status())
+            return
+        with self.jobs_lock:
+            job = self.jobs.get(token)
+        if job is None:
+            # finished jobs already sent their final status
+            self.send_status(self.job_error(token, "no running job %s" % token))
+        else:
+            self.send_status(job.get_status())
+
+    def stop_job_command(self, token, timeout=None):
+        """
+        Stop one job and keep the agent set up for the others
+        """
+        with self.jobs_lock:
+            job = self.jobs.get(token)
+        if job is not None:
+            job.cancel()
+            job.is_shutdown_ready(timeout=timeout or SHUTDOWN_TIMEOUT_SECONDS)
+        self.send({"response": "STOPPED", "payload": {"token": token}})
 
     def stop_command(self, timeout=SHUTDOWN_TIMEOUT_SECONDS):
+        jobs = self.running_jobs()
+        for job in jobs:
+            job.request_shutdown()
         self.process.request_shutdown()
-        self.process.is_shutdown_ready(timeout=timeout)
+        for job in jobs:
+            job.is_shutdown_ready(timeout=timeout)
+        # jobs with a token run on copies, the process itself only signals shutdown after running a START without one
+        if self.agent_thread is not None and self.agent_thread.is_alive():
+            self.process.is_shutdown_ready(timeout=timeout)
         self.process.shutdown()
         self.send({"response": "STOPPED"})
+        self.pipe.close()
         return True
 
+    @staticmethod
+    def job_error(token, msg):
+        status = SourcingStatus(running=False)
+        status.token = token
+        status.errorText = msg
+        return status
+
+    def format_command(self, name):
+        if name not in self.pipe.supported_formats():
+            self.log.warn("host requested unsupported pipe format %s" % name)
+            self.send({"response": "FORMAT", "payload": {"format": self.pipe.framing.name,
+                                                         "errorText": "unsupported format %s" % name}})
+            return
+        # the acknowledgement still uses the old framing, everything after it uses the new one
+        self.pipe.use_format(name, acknowledgement={"response": "FORMAT", "payload": {"format": name}})
+
     def send_status(self, status):
+        status.pipe = self.pipe.stats()
         self.send({"response": "STATUS", "payload": status})
 
     def is_shutdown(self, timeout):
@@ -0,0 +1,131 @@
+#
+# Copyright 2016 CognitiveScale, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import cPickle
+import hashlib
+import json
+import time
+from collections import OrderedDict
+from threading import Lock
+
+DEFAULT_PREDICTION_CACHE_BYTES = 256 * 1024 * 1024
+# returned by get when there is no usable entry, None is a valid prediction
+MISSING = object()
+
+
+def stable_hash(value):
+    """
+    Digest of a JSON value that does not depend on dict ordering
+    :return: hex digest or None if the value is not JSON serializable
+    """
+    try:
+        encoded = json.dumps(value, sort_keys=True, separators=(",", ":"))
+    except (TypeError, ValueError):
+        return None
+    return hashlib.sha1(encoded).hexdigest()
+
+
+class PredictionCache(object):
+    """
+    Predictions keyed by the model version and input value, evicted least recently used first once there are more
+    than max_entries of them or they take more than max_bytes, and dropped ttl seconds after they were stored.
+
+    Predictions are stored pickled and every hit unpickles a new copy, so a cached prediction comes back exactly as
+    a fresh one would and an agent or caller modifying it cannot change what later hits return.
+    """
+
+    def __init__(self, max_entries, ttl=None, max_bytes=DEFAULT_PREDICTION_CACHE_BYTES):
+        """
+        :param max_entries: most predictions kept
+        :param ttl: seconds a prediction is served for, None to keep it until it is evicted
+        :param max_bytes: most pickled bytes kept
+        """
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.lock = Lock()
+        # key -> (expires, pickled prediction), least recently used first
+        self.entries = OrderedDict()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    @staticmethod
+    def key(version, value):
+        """
+        :param version: digest of what the prediction depends on besides the value, i.e. the model config
+        :return: cache key or None when value cannot be cached
+        """
+        digest = stable_hash(value)
+        if digest is None or version is None:
+            return None
+        return version, digest
+
+    def contains(self, key):
+        """
+        :return: True if key holds a prediction that has not expired, which is neither unpickled nor counted as a hit
+        """
+        if key is None:
+            return False
+        with self.lock:
+            entry = self.entries.get(key)
+            return entry is not None and (entry[0] is None or entry[0] > time.time())
+
+    def get(self, key):
+        if key is None:
+            return MISSING
+        with self.lock:
+            entry = self.entries.pop(key, None)
+            if entry is not None and entry[0] is not None and entry[0] <= time.time():
+                self.bytes -= len(entry[1])
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return MISSING
+            self.entries[key] = entry
+            self.hits += 1
+        return cPickle.loads(entry[1])
+
+    def put(self, key, prediction):
+        if key is None:
+            return
+        try:
+            pickled = cPickle.dumps(prediction, cPickle.HIGHEST_PROTOCOL)
+        except Exception:
+            return
+        expires = time.time() + self.ttl if self.ttl else None
+        with self.lock:
+            previous = self.entries.pop(key, None)
+            if previous is not None:
+                self.bytes -= len(previous[1])
+            self.entries[key] = (expires, pickled)
+            self.bytes += len(pickled)
+            while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                (_, (_, evicted)) = self.entries.popitem(last=False)
+                self.bytes -= len(evicted)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {"entries": len(self.entries),
+                    "bytes": self.bytes,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions,
+                    "expirations": self.expirations}
@@ -0,0 +1,222 @@
+#
+# Copyright 2016 CognitiveScale, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import cProfile
+import os
+import pstats
+import sys
+import thread
+import threading
+import time
+from threading import Thread, Lock
+
+DETERMINISTIC = "deterministic"
+SAMPLING = "sampling"
+PROFILE_MODES = [SAMPLING, DETERMINISTIC]
+DEFAULT_SAMPLE_INTERVAL = 0.005
+
+AGENT = "agent"
+SDK = "sdk"
+LIBRARY = "library"
+ORIGINS = [AGENT, SDK, LIBRARY]
+
+# time threads spend blocked is left out of the report, these are the calls they block in
+_BLOCKING_BUILTINS = frozenset(["<method 'acquire' of 'thread.lock' objects>", "<time.sleep>", "<select.select>",
+                                "<method 'readline' of 'file' objects>", "<method 'read' of 'file' objects>",
+                                "<method 'recv' of '_socket.socket' objects>"])
+_BLOCKING_FUNCTIONS = frozenset([("threading.py", "wait"), ("threading.py", "join"), ("Queue.py", "get"),
+                                 ("Queue.py", "put"), ("framing.py", "read"), ("framing.py", "_read_exactly"),
+                                 ("socket.py", "readline"), ("socket.py", "read"), ("pool.py", "_handle_workers"),
+                                 ("pool.py", "_handle_tasks"), ("pool.py", "_handle_results")])
+
+_SDK_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__))) + os.sep
+_LIBRARY_DIRS = tuple(set(os.path.abspath(path) + os.sep for path in [sys.prefix, sys.exec_prefix]))
+
+
+def origin(filename):
+    """
+    Who owns the code in filename: the SDK (cogscale), a library (the standard library or anything installed next
+    to it, i.e. jsonpickle) or the agent being run
+    """
+    if not filename or filename[0] in "<~":
+        # builtins and generated code
+        return LIBRARY
+    path = os.path.abspath(filename)
+    if path.startswith(_SDK_DIR):
+        return SDK
+    if path.startswith(_LIBRARY_DIRS):
+        return LIBRARY
+    return AGENT
+
+
+def is_blocking(func):
+    (filename, line, name) = func
+    if filename == "~":
+        return name in _BLOCKING_BUILTINS
+    return (os.path.basename(filename), name) in _BLOCKING_FUNCTIONS
+
+
+def describe(func):
+    (filename, line, name) = func
+    if filename == "~":
+        return name
+    return "%s (%s:%d)" % (name, os.path.basename(filename), line)
+
+
+class Profiler(object):
+    """
+    Profiles every thread of a harness run.
+
+    The deterministic mode runs cProfile in each thread and reports exact call counts at the cost of slowing the
+    agent down noticeably.  The sampling mode records the stack of every thread at a fixed interval, which costs
+    little enough to leave on for a full run, and is also what flame graphs are built from.  Time threads spend
+    blocked on locks, queues or the pipe is left out.  Process workers are not profiled.
+    """
+
+    def __init__(self, mode=SAMPLING, interval=DEFAULT_SAMPLE_INTERVAL, stacks=False):
+        """
+        :param mode: deterministic or sampling
+        :param interval: seconds between samples
+        :param stacks: sample stacks in deterministic mode too so a flame graph can be written
+        """
+        if mode not in PROFILE_MODES:
+            raise ValueError("Unknown profile mode %s, expected one of %s" % (mode, PROFILE_MODES))
+        self.mode = mode
+        self.interval = interval
+        self.sampling = stacks or mode == SAMPLING
+        self.lock = Lock()
+        self.profiles = []
+        self.main_profile = None
+        self.samples = dict()
+        self.sample_count = 0
+        self.idle_samples = 0
+        self.running = False
+        self.sampler = None
+        self.started = None
+        self.elapsed = None
+
+    def start(self):
+        self.started = time.time()
+        self.running = True
+        if self.sampling:
+            # started ahead of the per thread profilers so the sampler does not profile itself
+            self.sampler = Thread(target=self._sample, name="profile_sampler")
+            self.sampler.daemon = True
+            self.sampler.start()
+        if self.mode == DETERMINISTIC:
+            threading.setprofile(self._profile_thread)
+            self.main_profile = self._profile_thread()
+
+    def stop(self):
+        if self.mode == DETERMINISTIC:
+            threading.setprofile(None)
+            self.main_profile.disable()
+        self.running = False
+        if self.sampler is not None:
+            self.sampler.join()
+        self.elapsed = time.time() - self.started
+
+    def _profile_thread(self, *args):
+        # installed by threading.setprofile, the first event of a new thread swaps this hook for its own profiler
+        if threading.current_thread() is self.sampler:
+            sys.setprofile(None)
+            return None
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+        return profile
+
+    def _sample(self):
+        own = thread.get_ident()
+        while self.running:
+            time.sleep(self.interval)
+            for (ident, frame) in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append((code.co_filename, code.co_firstlineno, code.co_name))
+                    frame = frame.f_back
+                if stack and is_blocking(stack[0]):
+                    self.idle_samples += 1
+                    continue
+                stack.reverse()
+                key = tuple(stack)
+                self.samples[key] = self.samples.get(key, 0) + 1
+            self.sample_count += 1
+
+    def functions(self):
+        """
+        :return: list of (func, self seconds, total seconds, calls or None) where func is (filename, line, name)
+        """
+        if self.mode == DETERMINISTIC:
+            with self.lock:
+                stats = pstats.Stats(*self.profiles)
+            return [(func, tt, ct, nc) for (func, (cc, nc, tt, ct, callers)) in stats.stats.iteritems()
+                    if not is_blocking(func)]
+        own = dict()
+        total = dict()
+        for (stack, count) in self.samples.iteritems():
+            if not stack:
+                continue
+            own[stack[-1]] = own.get(stack[-1], 0) + count
+            for func in set(stack):
+                total[func] = total.get(func, 0) + count
+        return [(func, own.get(func, 0) * self.interval, count * self.interval, None)
+                for (func, count) in total.iteritems()]
+
+    def write_report(self, out, limit=20):
+        """
+        Write the time spent in agent, SDK and library code followed by the most expensive functions of each
+        :param out: file to write to
+        :param limit: number of functions listed per origin
+        """
+        functions = self.functions()
+        by_origin = dict((name, []) for name in ORIGINS)
+        for row in functions:
+            by_origin[origin(row[0][0])].append(row)
+        own_total = sum(row[1] for row in functions) or 1.0
+        if self.mode == DETERMINISTIC:
+            print >> out, "Deterministic profile of %d threads over %.3fs" % (len(self.profiles), self.elapsed)
+        else:
+            print >> out, "Sampling profile, %d samples every %.1fms over %.3fs, %d idle thread samples left out" % (
+                self.sample_count, self.interval * 1000, self.elapsed, self.idle_samples)
+        print >> out
+        print >> out, "Own time by origin"
+        for name in ORIGINS:
+            own = sum(row[1] for row in by_origin[name])
+            print >> out, "  %-8s %10.3fs %6.1f%%" % (name, own, own * 100 / own_total)
+        for name in ORIGINS:
+            rows = sorted(by_origin[name], key=lambda row: row[1], reverse=True)[:limit]
+            if not rows:
+                continue
+            print >> out
+            print >> out, "Top %s functions" % name
+            print >> out, "  %10s %10s %10s  %s" % ("own", "total", "calls", "function")
+            for (func, own, total, calls) in rows:
+                print >> out, "  %9.3fs %9.3fs %10s  %s" % (own, total, calls if calls is not None else "-",
+                                                            describe(func))
+
+    def write_flamegraph(self, path):
+        """
+        Write the sampled stacks in the collapsed format read by flamegraph.pl and speedscope: one line per stack
+        of ';' separated frames followed by its sample count
+        """
+        with open(path, "w") as out:
+            for (stack, count) in sorted(self.samples.iteritems()):
+                print >> out, "%s %d" % (";".join(describe(func).replace(";", ":") for func in stack), count)
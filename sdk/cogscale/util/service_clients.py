@@ -15,10 +15,11 @@
 #
 
 from requests import Session
+from cogscale.util.model_store import ModelStore, CHUNK_SIZE
 import json
-import zipfile
+import os
+import shutil
 import sys
-import StringIO
 
 
 class DssClient(object):
@@ -34,16 +35,63 @@ class DssClient(object):
 
 
 class ModelRegistryClient(object):
-    def __init__(self, host_and_port):
+    def __init__(self, host_and_port, store=None):
+        """
+        :param store: ModelStore models are kept in, defaults to the store at $CS_MODEL_STORE or
+         ~/.cache/cogscale/models
+        """
         self.endpoint = "http://%s/api/v1/models/" % host_and_port
         self.session = Session()
+        self.store = store or ModelStore()
+
+    def fetch_model(self, slug, timestamp):
+        """
+        Make sure a model version is in the local store, downloading it if needed
+        :return: (directory the model is extracted in, metadata)
+        """
+        url = "%s/%s/%s/default" % (self.endpoint, slug, timestamp)
+
+        def download(offset):
+            headers = {"Range": "bytes=%d-" % offset} if offset else None
+            response = self.session.get("%s/model.bin" % url, headers=headers, stream=True)
+            if offset and response.status_code == 416:
+                # the previous attempt got every byte
+                return offset, iter([])
+            response.raise_for_status()
+            return (offset if response.status_code == 206 else 0), response.iter_content(CHUNK_SIZE)
+
+        def fetch_metadata():
+            metadata = self.session.get("%s/metadata" % url)
+            metadata.raise_for_status()
+            return metadata.json()
+
+        return self.store.retrieve(slug, timestamp, download, fetch_metadata)
 
     def retrieve_model(self, slug, timestamp, destination):
-        response = self.session.get("%s/%s/%s/default/model.bin" % (self.endpoint, slug, timestamp))
-        response.raise_for_status()
-        data = StringIO.StringIO(response.content)
-        z = zipfile.ZipFile(data)
-        z.extractall(destination)
-        metadata = self.session.get("%s/%s/%s/default/metadata" % (self.endpoint, slug, timestamp))
-        metadata.raise_for_status()
-        return metadata.json()
\ No newline at end of file
+        """
+        Put a model version in destination.  Its files are hard links to the read only files of the store, so this
+        takes no time whatever the size of the model.  They are only copied when destination is on another file
+        system.
+        :return: metadata
+        """
+        (model_dir, metadata) = self.fetch_model(slug, timestamp)
+        self._link_tree(model_dir, destination)
+        return metadata
+
+    @classmethod
+    def _link_tree(cls, source, destination):
+        # unlike shutil.copytree, files already in destination are replaced
+        if not os.path.isdir(destination):
+            os.makedirs(destination)
+        for name in os.listdir(source):
+            path = os.path.join(source, name)
+            target = os.path.join(destination, name)
+            if os.path.isdir(path):
+                cls._link_tree(path, target)
+                continue
+            if os.path.lexists(target):
+                os.unlink(target)
+            try:
+                os.link(path, target)
+            except OSError:
+                shutil.copy2(path, target)
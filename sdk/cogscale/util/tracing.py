@@ -0,0 +1,151 @@
+#
+# Copyright 2016 CognitiveScale, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+"""
+Opt-in spans written in the Chrome trace event format, readable by chrome://tracing, Perfetto or speedscope.
+
+    tracing.enable("run.trace.json")
+    with tracing.span("setup", "agent"):
+        ...
+    tracing.disable()
+
+span() returns a shared no-op object while tracing is off, so call sites can stay in hot paths.
+"""
+
+import json
+import os
+import thread
+import threading
+import time
+import types
+
+_tracer = None
+
+
+class Tracer(object):
+    def __init__(self, path):
+        self.path = path
+        self.pid = os.getpid()
+        self.started = time.time()
+        self.events = []
+        self.threads = dict()
+
+    def add(self, name, category, started, finished, args=None):
+        tid = thread.get_ident()
+        if tid not in self.threads:
+            self.threads[tid] = threading.current_thread().name
+        event = {"name": name, "cat": category, "ph": "X", "pid": self.pid, "tid": tid,
+                 "ts": (started - self.started) * 1000000, "dur": (finished - started) * 1000000}
+        if args:
+            event["args"] = args
+        # list.append is atomic, spans from every thread land in the same list
+        self.events.append(event)
+
+    def write(self):
+        names = [{"name": "thread_name", "ph": "M", "pid": self.pid, "tid": tid, "args": {"name": name}}
+                 for (tid, name) in self.threads.items()]
+        with open(self.path, "w") as out:
+            json.dump({"traceEvents": names + self.events, "displayTimeUnit": "ms"}, out)
+
+
+class _Span(object):
+    __slots__ = ["tracer", "name", "category", "args", "started"]
+
+    def __init__(self, tracer, name, category, args):
+        self.tracer = tracer
+        self.name = name
+        self.category = category
+        self.args = args
+        self.started = None
+
+    def __enter__(self):
+        self.started = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        self.tracer.add(self.name, self.category, self.started, time.time(), self.args)
+        return False
+
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        return False
+
+
+_NULL_SPAN = _NullSpan()
+
+
+def enable(path):
+    """
+    Start recording spans, they are written to path by disable()
+    """
+    global _tracer
+    _tracer = Tracer(path)
+    return _tracer
+
+
+def disable():
+    """
+    Stop recording and write the trace file
+    :return: path of the trace or None if tracing was off
+    """
+    global _tracer
+    tracer = _tracer
+    _tracer = None
+    if tracer is None:
+        return None
+    tracer.write()
+    return tracer.path
+
+
+def active():
+    return _tracer is not None
+
+
+def span(name, category="sdk", args=None):
+    """
+    Context manager recording a complete span on the calling thread
+    """
+    tracer = _tracer
+    if tracer is None:
+        return _NULL_SPAN
+    return _Span(tracer, name, category, args)
+
+
+def trace_iter(iterable, name, category="agent"):
+    """
+    Record a span for each step of a generator.  Anything else, or any generator while tracing is off, is returned
+    as is.
+    """
+    if _tracer is None or not isinstance(iterable, types.GeneratorType):
+        return iterable
+    return _traced_steps(iterable, name, category)
+
+
+def _traced_steps(iterator, name, category):
+    while True:
+        tracer = _tracer
+        started = time.time()
+        try:
+            item = next(iterator)
+        except StopIteration:
+            return
+        if tracer is not None:
+            tracer.add(name, category, started, time.time())
+        yield item
@@ -0,0 +1,242 @@
+#
+# Copyright 2016 CognitiveScale, Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+import itertools
+import multiprocessing
+import sys
+import time
+from collections import deque
+from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from Queue import Queue, Empty
+from threading import Lock, Thread
+
+THREAD_WORKERS = "thread"
+PROCESS_WORKERS = "process"
+WORKER_MODES = [THREAD_WORKERS, PROCESS_WORKERS]
+
+_STARTED = "started"
+_DONE = "done"
+
+# context handed to process workers and queue they report started items on, inherited when the pool forks
+_fork_context = None
+_fork_started = None
+
+
+def _run_item(started, key, func, context, item, keep_traceback):
+    """
+    :return: (True, result) or (False, exc_info), the traceback only when keep_traceback as it cannot be pickled
+    """
+    started(key, time.time())
+    try:
+        return True, func(context, item)
+    except Exception:
+        (error_type, error, tb) = sys.exc_info()
+        return False, (error_type, error, tb if keep_traceback else None)
+
+
+def _call_in_worker(task):
+    (func, item, key) = task
+    return _run_item(lambda started_key, at: _fork_started.put((started_key, at)), key, func, _fork_context, item,
+                     False)
+
+
+class WorkerTimeout(object):
+    """
+    Yielded in place of the result of an item that did not finish within the timeout of a worker starting it.  The
+    item is abandoned, not cancelled: it keeps running and keeps its worker busy, whatever it does meanwhile still
+    happens and only its result is dropped.
+    """
+
+    def __init__(self, item, timeout):
+        self.item = item
+        self.timeout = timeout
+
+
+class WorkerPool(object):
+    """
+    Runs func(context, item) over a stream of items on a pool of threads (I/O bound agents) or forked processes
+    (CPU bound agents).
+
+    Process workers are forked when the pool is created, so the context (i.e. an AgentEnvironment) must be set up
+    beforehand and func must be a module level function.  Items and results are pickled between processes.  Changes
+    to the context after the fork never reach the workers, retire the pool and create another one instead.
+    """
+
+    def __init__(self, size, mode=THREAD_WORKERS, context=None):
+        global _fork_context, _fork_started
+        if mode not in WORKER_MODES:
+            raise ValueError("Unknown worker mode %s, expected one of %s" % (mode, WORKER_MODES))
+        self.size = size
+        self.mode = mode
+        self.context = context
+        self.lock = Lock()
+        # imap calls in progress, a retired pool is closed once the last one finishes
+        self.users = 0
+        self.retired = False
+        # keep a couple of items queued per worker without reading the whole input ahead
+        self.window = size * 2
+        self.keys = itertools.count()
+        # key of a submitted item -> event queue of the imap call it belongs to
+        self.listeners = dict()
+        self.started = None
+        self.dispatcher = None
+        if mode == PROCESS_WORKERS:
+            self.started = multiprocessing.Queue()
+            (_fork_context, _fork_started) = (context, self.started)
+            self.pool = Pool(size)
+            self.dispatcher = Thread(target=self._dispatch_started, name="worker_pool_started")
+            self.dispatcher.daemon = True
+            self.dispatcher.start()
+        else:
+            self.pool = ThreadPool(size)
+
+    def imap(self, func, items, timeout=None):
+        """
+        Results of func(context, item) in the order of items.  Items are only read as workers free up, so closing
+        the generator early stops any further submissions.  An item that raised raises in its turn.
+        :param timeout: seconds an item may take once a worker starts it, a WorkerTimeout is yielded for late items
+        """
+        return self._run(func, items, timeout, ordered=True)
+
+    def imap_unordered(self, func, items, timeout=None):
+        """
+        Results of func(context, item) as soon as each one completes.  An item that raised raises as soon as it
+        completes.
+        :param timeout: seconds an item may take once a worker starts it, a WorkerTimeout is yielded for late items
+         and their eventual results are dropped
+        """
+        return self._run(func, items, timeout, ordered=False)
+
+    def _run(self, func, items, timeout, ordered):
+        events = Queue()
+        # key -> [item, deadline once a worker started it]
+        in_flight = dict()
+        # timed out items still running, they keep their worker and their window slot
+        abandoned = set()
+        # ordered results waiting for earlier items, key -> (success, result or exc_info)
+        finished = dict()
+        order = deque()
+        items = iter(items)
+        exhausted = False
+        self._acquire()
+        try:
+            while True:
+                while order and order[0] in finished:
+                    yield self._outcome(*finished.pop(order.popleft()))
+                while not exhausted and len(in_flight) + len(abandoned) + len(finished) < self.window:
+                    try:
+                        item = next(items)
+                    except StopIteration:
+                        exhausted = True
+                        break
+                    key = self._submit(func, item, events)
+                    in_flight[key] = [item, None]
+                    if ordered:
+                        order.append(key)
+                if not in_flight and exhausted:
+                    return
+                deadlines = [deadline for (_, deadline) in in_flight.itervalues() if deadline is not None]
+                try:
+                    (kind, key, value) = events.get(timeout=max(0.0, min(deadlines) - time.time()) if deadlines
+                                                    else None)
+                except Empty:
+                    now = time.time()
+                    for (key, (item, deadline)) in in_flight.items():
+                        if deadline is not None and deadline <= now:
+                            del in_flight[key]
+                            abandoned.add(key)
+                            if ordered:
+                                finished[key] = (True, WorkerTimeout(item, timeout))
+                            else:
+                                yield WorkerTimeout(item, timeout)
+                    continue
+                if kind == _STARTED:
+                    if timeout is not None and key in in_flight:
+                        in_flight[key][1] = value + timeout
+                    continue
+                abandoned.discard(key)
+                if in_flight.pop(key, None) is None:
+                    continue
+                if ordered:
+                    finished[key] = value
+                else:
+                    yield self._outcome(*value)
+        finally:
+            with self.lock:
+                for key in itertools.chain(in_flight, abandoned):
+                    self.listeners.pop(key, None)
+            self._release()
+
+    def _submit(self, func, item, events):
+        with self.lock:
+            key = next(self.keys)
+            self.listeners[key] = events
+        callback = lambda outcome: self._notify(_DONE, key, outcome)
+        if self.mode == PROCESS_WORKERS:
+            self.pool.apply_async(_call_in_worker, ((func, item, key),), callback=callback)
+        else:
+            started = lambda started_key, at: self._notify(_STARTED, started_key, at)
+            self.pool.apply_async(_run_item, (started, key, func, self.context, item, True), callback=callback)
+        return key
+
+    def _notify(self, kind, key, value):
+        with self.lock:
+            events = self.listeners.pop(key, None) if kind == _DONE else self.listeners.get(key)
+        if events is not None:
+            events.put((kind, key, value))
+
+    def _dispatch_started(self):
+        while True:
+            started = self.started.get()
+            if started is None:
+                return
+            self._notify(_STARTED, *started)
+
+    @staticmethod
+    def _outcome(success, result):
+        if not success:
+            raise result[0], result[1], result[2]
+        return result
+
+    def _acquire(self):
+        with self.lock:
+            self.users += 1
+
+    def _release(self):
+        with self.lock:
+            self.users -= 1
+            idle = self.retired and not self.users
+        if idle:
+            self.pool.close()
+
+    def retire(self):
+        """
+        Stop taking work once the imap calls in progress finish, the workers exit after their last item.  Call close
+        later to wait for them.
+        """
+        with self.lock:
+            self.retired = True
+            idle = not self.users
+        if idle:
+            self.pool.close()
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+        if self.dispatcher is not None:
+            self.started.put(None)
+            self.dispatcher.join()